@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+==============================================
+Existence checks in a folder with many children
+==============================================
+
+Compares the former ``obj_id not in container.objectIds()`` check of
+``SPMTSyncView.check_and_create_object`` with the keyed ``_getOb`` lookup
+it uses now, on a BTree based folder with thousands of children::
+
+  python benchmarks/bench_existence.py [number of children ...]
+"""
+import sys
+import timeit
+
+from OFS.SimpleItem import SimpleItem
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
+
+
+def make_folder(size):
+    folder = BTreeFolder2('portfolio')
+    for i in range(size):
+        item = SimpleItem()
+        item.id = 'service-%d' % i
+        folder._setObject(item.id, item)
+    return folder
+
+
+def bench(size, lookups=1000):
+    folder = make_folder(size)
+    ids = ['service-%d' % (i * 7 % (2 * size)) for i in range(lookups)]
+
+    def objectids_check():
+        for id in ids:
+            id not in folder.objectIds()
+
+    def keyed_check():
+        for id in ids:
+            folder._getOb(id, None) is None
+
+    return (min(timeit.repeat(objectids_check, number=1, repeat=3)),
+            min(timeit.repeat(keyed_check, number=1, repeat=3)))
+
+
+def main(sizes):
+    print('%10s %18s %18s %8s' % ('children', 'objectIds() [ms]',
+                                  '_getOb() [ms]', 'speedup'))
+    for size in sizes:
+        listing, keyed = bench(size)
+        print('%10d %18.2f %18.2f %7.0fx' % (size, listing * 1000,
+                                            keyed * 1000, listing / keyed))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000, 10000])
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+=============================
+Benchmarks of the SPMT sync
+=============================
+
+Runs ``SPMTSyncView.sync`` on a Plone test site against a local SPMT
+stand-in (see ``tests/spmtstub.py``) serving synthetic portfolios, and
+reports for a cold sync, a warm no-op sync (full and incremental) and the
+sync of a small change the time taken, the number of requests to SPMT (and how
+many of them were answered with 304) and the number of objects written to
+the ZODB::
+
+  zope-testrunner --test-path=tests --test-path=benchmarks \
+                  --tests-pattern='^bench_sync$' -vv
+
+Portfolio sizes and fan-out are read from the environment, for example::
+
+  SPMTSYNC_BENCH_SIZES=10,100,1000 SPMTSYNC_BENCH_FANOUT=2,2,2
+
+where the fan-out is the number of components per service,
+implementations per component and versions per implementation.
+"""
+import os
+import time
+
+import transaction
+
+from functional import SPMTSyncTestCase
+from spmtstub import SyntheticPortfolio
+
+
+def environ_ints(name, default):
+    value = os.environ.get(name, '')
+    return [int(item) for item in value.split(',') if item] or default
+
+
+SIZES = environ_ints('SPMTSYNC_BENCH_SIZES', [10, 100, 1000])
+FANOUT = environ_ints('SPMTSYNC_BENCH_FANOUT', [2, 2, 2])
+
+
+class SyncBenchmark(SPMTSyncTestCase):
+    """Cold, warm and small-delta syncs of synthetic portfolios"""
+
+    def run_sync(self, folder, **options):
+        from pcp.spmtsync.browser.sync import SPMTSyncView
+        self.stub.reset_counts()
+        jar = folder._p_jar
+        jar.getTransferCounts(True)
+        started = time.time()
+        SPMTSyncView(folder, self.request).sync(**options)
+        transaction.commit()
+        elapsed = time.time() - started
+        loads, stores = jar.getTransferCounts(True)
+        return elapsed, self.stub.requests, self.stub.not_modified, stores
+
+    def test_sync(self):
+        print('')
+        print('fan-out (components, implementations, versions): %s'
+              % ', '.join(str(n) for n in FANOUT))
+        print('%8s %-18s %10s %10s %8s %12s' % (
+            'services', 'run', 'time [s]', 'requests', '304s',
+            'objects'))
+        for size in SIZES:
+            portfolio = SyntheticPortfolio(
+                self.stub.base_url, size, *FANOUT)
+            self.stub.serve(portfolio)
+            folder = self.setup_site(portfolio)
+            runs = [
+                ('cold', {}),
+                ('warm no-op', {}),
+                ('warm incremental', {'incremental': True}),
+            ]
+            for name, options in runs:
+                self.report(size, name, self.run_sync(folder, **options))
+            portfolio.change(max(1, size // 100))
+            self.report(size, 'small delta',
+                        self.run_sync(folder, incremental=True))
+
+    def report(self, size, name, result):
+        print('%8d %-18s %10.2f %10d %8d %12d' % ((size, name) + result))
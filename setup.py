@@ -49,9 +49,13 @@ setup(name='pcp.spmtsync',
           'deep',
           ],
       entry_points={
+          'console_scripts': [
+              'spmtsync = pcp.spmtsync.console:main',
+              ],
           },
       tests_require=dev_require,
       test_suite='tests.all_tests',
       extras_require={
-          'dev': dev_require
+          'dev': dev_require,
+          'streaming': ['ijson>=3.1'],
       })
@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing service for a while.
+
+    After `threshold` consecutive failures the breaker opens and `allow`
+    returns False for `reset_after` seconds. Then a single trial call is
+    let through: its success closes the breaker again, its failure opens
+    it for another `reset_after` seconds. A `threshold` of 0 disables the
+    breaker. All methods are thread safe.
+    """
+
+    def __init__(self, threshold=10, reset_after=30.0, clock=time.time):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.trips = 0
+        self.opened = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        """True if a call may be made"""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self._clock() - self.opened < self.reset_after:
+                return False
+            # half open: let this call through and keep the others out
+            self.opened = self._clock()
+            return True
+
+    def success(self):
+        """Record a successful call"""
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        """Record a failed call"""
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if self.opened is None:
+                    self.trips += 1
+                self.opened = self._clock()
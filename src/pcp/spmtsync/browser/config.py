@@ -12,6 +12,13 @@ link_fields = [
 ]
 
 
+# ids of containers below the target folder whose content is
+# maintained in DPMT rather than SPMT - never made private by the sync
+dpmt_only_ids = [
+    'options',
+]
+
+
 # email mapping for the few exceptions we have
 creg2dp_email = {
     'stranak@ufal.mff.cuni.cz': 'pavel.stranak@gmail.com',
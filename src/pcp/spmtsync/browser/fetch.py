@@ -0,0 +1,281 @@
+import copy
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from zope.component import getUtility
+from plone.registry.interfaces import IRegistry
+
+from pcp.spmtsync.browser import utils
+from pcp.spmtsync.browser import httpcache
+from pcp.spmtsync.browser.breaker import CircuitBreaker
+
+
+logger = logging.getLogger('spmtsync')
+
+
+def related_link(data, field):
+    """Return the 'related' href of the embedded link `field` in `data`"""
+    return data[field]['related']['href']
+
+
+def details_link(details):
+    """Return the URL of the full service details document.
+    Works on raw and on already flattened (see `flatten_links`) details."""
+    links = details['links']
+    if isinstance(links, dict):
+        return links['self']
+    return links
+
+
+def components_of(full_details):
+    """Return the embedded component data of a full service details document"""
+    scl = (full_details or {}).get('service_components_list', None)
+    if scl is None:
+        return []
+    return [sc['component'] for sc in scl['service_components']]
+
+
+def implementations_of(implementations_data):
+    """Return the implementations listed in an implementations document"""
+    if not implementations_data:
+        return []
+    return implementations_data['service_component_implementations_list'][
+        'service_component_implementations'] or []
+
+
+def implementation_details_of(details_data):
+    """Return the implementation details listed in a details document"""
+    if not details_data:
+        return []
+    return details_data['service_component_implementation_details_list'][
+        'service_component_implementation_details'] or []
+
+
+def contact_link(entry):
+    """Return the URL of the contact of a portfolio entry or None"""
+    contact_info = entry.get('contact_information', None)
+    if contact_info is None:
+        return None
+    return contact_info['links']['self']
+
+
+def contact_email(contact_data):
+    """Return the email address of a SPMT contact document"""
+    try:
+        return contact_data['external_contact_information']['email']
+    except TypeError:
+        return 'noreply@nowhere.org'
+
+
+def fetcherFromRegistry(concurrency=None):
+    """Return a SPMTFetcher configured from the plone.app.registry settings
+    (`concurrency` overrides the 'pcp.spmtsync.concurrency' setting)"""
+    registry = getUtility(IRegistry)
+    if not concurrency:
+        concurrency = registry.get('pcp.spmtsync.concurrency', 8)
+    cache = None
+    cachedir = registry.get('pcp.spmtsync.cachedir', None)
+    if cachedir:
+        cachesize = registry.get('pcp.spmtsync.cachesize', 50)
+        try:
+            cache = httpcache.ResponseCache(
+                cachedir, max_size=cachesize * 1024 * 1024)
+        except (IOError, OSError) as exc:
+            logger.warning('The response cache directory {} cannot be '
+                           'created - not caching: {}'.format(cachedir, exc))
+    return SPMTFetcher(
+        concurrency=concurrency, cache=cache,
+        timeout=registry.get('pcp.spmtsync.timeout', 30),
+        retries=registry.get('pcp.spmtsync.retries', 3),
+        breaker=CircuitBreaker(
+            threshold=registry.get('pcp.spmtsync.failure_threshold', 10)))
+
+
+class SPMTFetcher(object):
+    """Fetch SPMT documents through one pooled HTTP session.
+
+    Payloads are memoized by URL for the lifetime of the fetcher so the
+    create/update code can read documents fetched ahead of time by
+    `prefetch` from memory. Network access runs with at most
+    `concurrency` requests in flight. An optional `cache`
+    (httpcache.ResponseCache) turns repeated downloads across runs
+    into conditional requests. Responses are recorded in `metrics`
+    (metrics.SyncMetrics) if set.
+
+    Each request is bounded by `timeout` seconds and transient errors
+    are retried up to `retries` times (see utils.requestSPMT). While the
+    optional `breaker` (breaker.CircuitBreaker) is open after repeated
+    failures, no requests are made at all. URLs that could not be
+    fetched are collected in `failed` with the reason and yield None.
+    """
+
+    def __init__(self, concurrency=8, cache=None, metrics=None, timeout=30,
+                 retries=3, breaker=None):
+        self.concurrency = max(1, int(concurrency))
+        self.cache = cache
+        self.metrics = metrics
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker
+        self.failed = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.concurrency,
+            pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Return (a copy of) the payload from `url` or None (see
+        `getDataFromSPMT`); the sync modifies the payloads it gets"""
+        return copy.deepcopy(self._load(url))
+
+    def _load(self, url):
+        """Return the memoized payload from `url`, fetching it if needed"""
+        with self._lock:
+            if url in self._documents:
+                return self._documents[url]
+        data = None
+        reason = None
+        if self.breaker is not None and not self.breaker.allow():
+            self.record_failure(url, 'circuit open')
+        else:
+            try:
+                body = utils.requestSPMT(
+                    url, session=self.session, cache=self.cache,
+                    metrics=self.metrics, timeout=self.timeout,
+                    retries=self.retries)
+            except utils.SPMTFetchError as exc:
+                reason = str(exc)
+            except Exception as exc:
+                # runs in a worker thread - one bad URL must not abort the
+                # whole sync
+                logger.exception("Unexpected error fetching '{}'".format(url))
+                reason = exc.__class__.__name__
+            if reason is not None:
+                self.record_failure(url, reason)
+                if self.breaker is not None:
+                    self.breaker.failure()
+            else:
+                data = utils.payload(body)
+                if self.breaker is not None:
+                    self.breaker.success()
+        with self._lock:
+            self._documents[url] = data
+        return data
+
+    def record_failure(self, url, reason):
+        logger.warning("Fetching '{}' failed: {}".format(url, reason))
+        with self._lock:
+            self.failed[url] = reason
+        if self.metrics is not None:
+            self.metrics.record_failure(url, reason)
+
+    def documents(self):
+        """Return the mapping URL -> payload of the memoized documents"""
+        with self._lock:
+            return dict(self._documents)
+
+    def clear(self):
+        """Drop all memoized payloads (but not the record of failures)"""
+        with self._lock:
+            self._documents.clear()
+
+    def fetch_all(self, urls):
+        """Fetch all `urls` concurrently and return their payloads
+        in the same order (not copied - do not modify them)."""
+        urls = [url for url in urls if url]
+        with self._lock:
+            missing = [url for url in set(urls) if url not in self._documents]
+        if len(missing) > 1 and self.concurrency > 1:
+            pool = ThreadPool(min(self.concurrency, len(missing)))
+            try:
+                pool.map(self._load, missing)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for url in missing:
+                self._load(url)
+        return [self._documents.get(url) for url in urls]
+
+    def prefetch(self, services):
+        """Walk the SPMT link graph below the portfolio entries `services`
+        (service details, components, implementations and implementation
+        details) one level at a time so the total time is bounded by the
+        slowest request per level rather than by the number of requests."""
+        details = []
+        for entry in services or []:
+            try:
+                details.append(
+                    entry['service_details_list']['service_details'][0])
+            except (IndexError, KeyError, TypeError):
+                continue
+        self.prefetch_details(details)
+
+    def prefetch_details(self, details):
+        """Like `prefetch` but starting from a list of service details"""
+        components = []
+        for full_details in self.fetch_all(
+                [details_link(node) for node in details]):
+            components.extend(components_of(full_details))
+
+        implementations = []
+        for data in self.fetch_all([
+                related_link(component, 'service_component_implementations_link')
+                for component in components]):
+            implementations.extend(implementations_of(data))
+
+        self.fetch_all([
+            related_link(impl, 'component_implementation_details_link')
+            for impl in implementations])
+
+        logger.debug('Prefetched {} SPMT documents'.format(len(self._documents)))
+
+
+class ContactResolver(object):
+    """Resolve SPMT contact links to the UIDs of the Persons with the
+    contacts' email addresses (`email2puid`, see utils.email2puid).
+
+    Many services share a contact, so every contact document is fetched
+    only once per resolver; `prefetch` fetches the contacts of a batch of
+    portfolio entries concurrently through `fetcher`. The resolved
+    addresses outlive the fetcher's documents, which streaming syncs drop
+    between chunks.
+    """
+
+    def __init__(self, fetcher, email2puid):
+        self.fetcher = fetcher
+        self.email2puid = email2puid
+        self._emails = {}
+
+    def prefetch(self, entries):
+        """Fetch the not yet resolved contacts of the portfolio `entries`"""
+        urls = set(contact_link(entry) for entry in entries)
+        urls = [url for url in urls if url and url not in self._emails]
+        for url, data in zip(urls, self.fetcher.fetch_all(urls)):
+            self._emails[url] = contact_email(data)
+
+    def email(self, url):
+        """Return the email address of the contact at `url`"""
+        if url not in self._emails:
+            self._emails[url] = contact_email(self.fetcher.get(url))
+        return self._emails[url]
+
+    def resolve(self, url):
+        """Return the email address of the contact at `url` and the UID of
+        the corresponding Person (None if there is none)"""
+        email = self.email(url)
+        return email, self.email2puid.get(email.lower(), None)
+
+    def mapping(self):
+        """Return the email -> Person UID mapping of the contacts resolved
+        so far"""
+        return dict((email, self.email2puid.get(email.lower(), None))
+                    for email in set(self._emails.values()))
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+logger = logging.getLogger('spmtsync')
+
+
+class ResponseCache(object):
+    """Persistent on-disk cache of SPMT responses.
+
+    Each URL is stored as one JSON file holding the decoded body together
+    with the `ETag` and `Last-Modified` validators of the response, so
+    later requests can be made conditional and a `304 Not Modified` can be
+    answered from disk. The total size of the cache is bounded by
+    `max_size` bytes; the least recently used entries (by file
+    modification time, refreshed on every hit) are evicted first.
+    """
+
+    def __init__(self, directory, max_size=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url):
+        if not isinstance(url, bytes):
+            url = url.encode('utf8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def _entries(self):
+        """Return (mtime, size, path) for all cache files"""
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def lookup(self, url):
+        """Return the cached entry for `url` or None and mark it as used"""
+        path = self._path(url)
+        try:
+            with open(path) as fp:
+                entry = json.load(fp)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        """Return the request headers revalidating the cached `entry`"""
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response, body):
+        """Store the decoded `body` of `response` if it carries validators"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        entry = {'url': url,
+                 'etag': etag,
+                 'last_modified': last_modified,
+                 'body': body}
+        path = self._path(url)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+        with self._lock:
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.rename(tmp, path)
+            if self._size is not None:
+                self._size += os.stat(path).st_size - old_size
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until below `max_size`"""
+        if self._size is None:
+            self._size = sum(size for mtime, size, path in self._entries())
+        if self._size <= self.max_size:
+            return
+        for mtime, size, path in sorted(self._entries()):
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            logger.debug('Evicted {} from the response cache'.format(path))
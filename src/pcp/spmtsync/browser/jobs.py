@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+import traceback
+import uuid
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+import plone.api
+import transaction
+
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from zope.component.hooks import setSite
+
+
+logger = logging.getLogger('spmtsync')
+
+# number of finished jobs whose status is kept
+MAX_JOBS = 20
+
+# job id -> status of the sync jobs of this process (see startSyncJob)
+_jobs = OrderedDict()
+_queue = Queue()
+_worker = None
+_lock = threading.Lock()
+
+
+@contextmanager
+def siteContext(app, site_path, userid):
+    """Set up the Plone site at `site_path` and the user `userid` of
+    `app` for a sync outside of a web request and yield the application
+    wrapped in a request"""
+    app = makerequest(app)
+    site = app.unrestrictedTraverse(site_path)
+    setSite(site)
+    try:
+        acl_users = site.acl_users
+        user = acl_users.getUserById(userid)
+        if user is None:
+            acl_users = app.acl_users
+            user = acl_users.getUserById(userid)
+        if user is None:
+            raise ValueError("Unknown user '%s'" % userid)
+        if not hasattr(user, 'aq_base'):
+            user = user.__of__(acl_users)
+        newSecurityManager(None, user)
+        yield app
+    finally:
+        noSecurityManager()
+        setSite(None)
+
+
+def runSync(app, site_path, folder_path, userid, options, progress=None,
+            retries=3):
+    """Run SPMTSyncView.sync with `options` on the folder at `folder_path`
+    of the Plone site at `site_path` as the user `userid` and commit.
+    With the option `dry_run` set SPMTSyncView.plan is run instead and
+    nothing is committed; with the option `services` (a list of SPMT
+    uuids) only those are synced (see SPMTSyncView.sync_services).
+    A ConflictError makes the sync start over up to `retries` times.
+    `progress` is a dictionary the view keeps up to date (see
+    SPMTSyncView.report_progress). Returns the view used."""
+    from pcp.spmtsync.browser.sync import SPMTSyncView
+
+    options = dict(options)
+    dry_run = options.pop('dry_run', False)
+    services = options.pop('services', None)
+    with siteContext(app, site_path, userid) as app:
+        for attempt in range(1, retries + 1):
+            folder = app.unrestrictedTraverse(folder_path)
+            view = SPMTSyncView(folder, app.REQUEST)
+            view.progress = progress
+            if progress is not None:
+                progress['metrics'] = view.metrics
+            try:
+                if dry_run:
+                    view.plan(**options)
+                    transaction.abort()
+                elif services:
+                    view.sync_services(services, **options)
+                    transaction.commit()
+                else:
+                    options.pop('partition', None)
+                    view.sync(**options)
+                    transaction.commit()
+                return view
+            except ConflictError:
+                transaction.abort()
+                if attempt == retries:
+                    raise
+                logger.warning('Conflict while syncing {} - starting over '
+                               '({}/{})'.format(folder_path, attempt, retries))
+
+
+def runPartitionedSync(app, site_path, folder_path, userid, snapshot_path,
+                       command, partitions, workers=None, options=None,
+                       retries=3):
+    """Sync the folder at `folder_path` from the snapshot file
+    `snapshot_path` by `partitions` worker processes started with
+    `command` (see coordinator.runPartitions for the `options`).
+    Returns the view used and the results of the workers."""
+    from pcp.spmtsync import coordinator
+    from pcp.spmtsync.browser import snapshots
+    from pcp.spmtsync.browser.sync import SPMTSyncView
+
+    options = dict(options or {})
+    snapshot = snapshots.Snapshot.load(snapshot_path)
+    with siteContext(app, site_path, userid) as app:
+        folder = app.unrestrictedTraverse(folder_path)
+        view = SPMTSyncView(folder, app.REQUEST)
+        uuids = view.create_services(
+            snapshot, incremental=options.get('incremental', False))
+        transaction.commit()
+
+        parts = [uuids[i::partitions] for i in range(partitions)]
+        results = coordinator.runPartitions(
+            command, folder_path, snapshot_path,
+            [part for part in parts if part], workers=workers, **options)
+        if [result for result in results if result['status']]:
+            logger.error('Not all partitions of {} were synced - skipping '
+                         'the dependencies and privatising'.format(
+                             folder_path))
+            return view, results
+
+        touched = set()
+        fingerprints = {}
+        uuids = {}
+        for result in results:
+            output = result.get('summary', {})
+            touched.update(output.get('touched', ()))
+            fingerprints.update(output.get('fingerprints', {}))
+            uuids.update(output.get('uuids', {}))
+        for attempt in range(1, retries + 1):
+            transaction.begin()
+            try:
+                view.finish_partitions(snapshot, touched, fingerprints, uuids)
+                transaction.commit()
+                return view, results
+            except ConflictError:
+                transaction.abort()
+                if attempt == retries:
+                    raise
+                logger.warning('Conflict while finishing {} - starting over '
+                               '({}/{})'.format(folder_path, attempt, retries))
+
+
+def _work():
+    """Run the queued sync jobs one after the other"""
+    while True:
+        job, db = _queue.get()
+        connection = db.open()
+        job['state'] = 'running'
+        job['started'] = time.time()
+        try:
+            app = connection.root()['Application']
+            runSync(app, job['site'], job['folder'], job['user'],
+                    job['options'], progress=job)
+            job['state'] = 'done'
+        except Exception:
+            transaction.abort()
+            job['state'] = 'failed'
+            job['errors'].append(traceback.format_exc())
+            logger.exception('Sync job {} failed'.format(job['id']))
+        finally:
+            job['finished'] = time.time()
+            connection.close()
+
+
+def startSyncJob(folder, options):
+    """Queue a sync of `folder` with `options` (the keyword arguments of
+    SPMTSyncView.sync) for the background worker of this process and
+    return the job id"""
+    global _worker
+    job = {
+        'id': uuid.uuid4().hex,
+        'state': 'queued',
+        'site': '/'.join(plone.api.portal.get().getPhysicalPath()),
+        'folder': '/'.join(folder.getPhysicalPath()),
+        'user': plone.api.user.get_current().getId(),
+        'options': options,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'pass': None,
+        'done': 0,
+        'total': None,
+        'errors': [],
+    }
+    with _lock:
+        finished = [id for id, other in _jobs.items()
+                    if other['state'] in ('done', 'failed')]
+        for id in finished[:max(0, len(finished) - MAX_JOBS)]:
+            del _jobs[id]
+        _jobs[job['id']] = job
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='spmtsync-worker')
+            _worker.daemon = True
+            _worker.start()
+    _queue.put((job, folder._p_jar.db()))
+    return job['id']
+
+
+def jobStatus(job_id):
+    """Return the status of the job `job_id` as JSON serializable
+    dictionary or None if this process does not know the job"""
+    job = _jobs.get(job_id, None)
+    if job is None:
+        return None
+    status = dict((key, value) for key, value in job.items()
+                  if key != 'metrics')
+    status['errors'] = list(job['errors'])
+    metrics = job.get('metrics', None)
+    if metrics is not None:
+        status['phase'] = metrics.current_phase
+        status['counters'] = dict(metrics.counters)
+    return status
@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+
+from logging.handlers import RotatingFileHandler
+
+
+LOGGER_NAME = 'spmtsync'
+
+# rotation of the sync log
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+_lock = threading.Lock()
+_configured = None
+
+
+class Payload(object):
+    """A SPMT payload passed as argument to a logging call. It is only
+    turned into text (and then truncated to `limit` characters) if the
+    message is actually emitted."""
+
+    limit = 1000
+
+    def __init__(self, data, limit=None):
+        self.data = data
+        if limit is not None:
+            self.limit = limit
+
+    def __str__(self):
+        text = repr(self.data)
+        if self.limit and len(text) > self.limit:
+            return '{}... ({} characters)'.format(text[:self.limit], len(text))
+        return text
+
+    __repr__ = __str__
+
+
+class PayloadSampler(logging.Filter):
+    """Let only every `every`-th debug message that carries a Payload
+    through, so that logging all payloads of a large sync does not
+    dominate its run time and the log"""
+
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        if not [arg for arg in args if isinstance(arg, Payload)]:
+            return True
+        with self._lock:
+            self.seen += 1
+            return (self.seen - 1) % self.every == 0
+
+
+def _ours(obj):
+    return getattr(obj, '_spmtsync', False)
+
+
+def configureLogging(logfile='var/log/spmtsync.log', level='INFO', sample=1):
+    """Set up the 'spmtsync' logger: messages of at least `level` go to the
+    rotating `logfile` (relative paths are relative to the working
+    directory; no file is written if its directory does not exist),
+    warnings also to the console, and only every `sample`-th debug
+    message with a Payload is kept (see PayloadSampler).
+    Meant to be called at the start of a sync rather than on import;
+    calling it again with the same arguments does nothing."""
+    global _configured
+    logger = logging.getLogger(LOGGER_NAME)
+    if not isinstance(level, int):
+        level = logging.getLevelName(str(level).upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    if logfile:
+        logfile = os.path.abspath(logfile)
+    with _lock:
+        if _configured == (logfile, level, sample):
+            return logger
+        for handler in [h for h in logger.handlers if _ours(h)]:
+            logger.removeHandler(handler)
+            handler.close()
+        for sampler in [f for f in logger.filters if _ours(f)]:
+            logger.removeFilter(sampler)
+        logger.setLevel(level)
+
+        console = logging.StreamHandler()
+        console.setLevel(logging.WARNING)
+        console.setFormatter(logging.Formatter(
+            '%(name)s - %(levelname)s - %(message)s'))
+        console._spmtsync = True
+        logger.addHandler(console)
+
+        if logfile and os.path.isdir(os.path.dirname(logfile)):
+            handler = RotatingFileHandler(logfile, maxBytes=MAX_BYTES,
+                                          backupCount=BACKUP_COUNT)
+            handler.setLevel(level)
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            handler._spmtsync = True
+            logger.addHandler(handler)
+        elif logfile:
+            logger.warning('The directory of the sync log {} does not exist '
+                           '- not logging to a file'.format(logfile))
+
+        if sample and sample > 1:
+            sampler = PayloadSampler(sample)
+            sampler._spmtsync = True
+            logger.addFilter(sampler)
+        _configured = (logfile, level, sample)
+    return logger
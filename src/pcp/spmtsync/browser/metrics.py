@@ -0,0 +1,96 @@
+import heapq
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    cpu_time = time.process_time
+except AttributeError:  # Python 2
+    cpu_time = time.clock
+
+
+class SyncMetrics(object):
+    """Timers and counters of one sync run.
+
+    `phase` measures wall clock and CPU time per named phase (phases may
+    nest; the times are inclusive), `count` increments named counters and
+    `record_fetch` keeps track of the number and size of SPMT responses
+    and of the `slowest` URLs and `record_failure` of the URLs that could
+    not be fetched. All methods are thread safe.
+    """
+
+    def __init__(self, slowest=10):
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.counters = {}
+        self.bytes_downloaded = 0
+        self.current_phase = None
+        self._slowest = slowest
+        self._fetches = []
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as (part of) phase `name`"""
+        previous, self.current_phase = self.current_phase, name
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            with self._lock:
+                timing = self.phases.setdefault(
+                    name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+                timing['wall'] += wall
+                timing['cpu'] += cpu
+                timing['calls'] += 1
+            self.current_phase = previous
+
+    def count(self, name, increment=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def record_fetch(self, url, seconds, size, status):
+        """Record a response of `size` bytes from `url`"""
+        with self._lock:
+            self.counters['fetches'] = self.counters.get('fetches', 0) + 1
+            if status == 304:
+                self.counters['not_modified'] = \
+                    self.counters.get('not_modified', 0) + 1
+            self.bytes_downloaded += size
+            entry = (seconds, url)
+            if len(self._fetches) < self._slowest:
+                heapq.heappush(self._fetches, entry)
+            elif entry > self._fetches[0]:
+                heapq.heapreplace(self._fetches, entry)
+
+    def record_failure(self, url, reason):
+        """Record that `url` could not be fetched"""
+        with self._lock:
+            self.counters['failed_fetches'] = \
+                self.counters.get('failed_fetches', 0) + 1
+            self._failures[url] = reason
+
+    def summary(self):
+        """Return the metrics as a JSON serializable dictionary"""
+        with self._lock:
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                         time.localtime(self.started)),
+                'duration': round(time.time() - self.started, 3),
+                'phases': OrderedDict(
+                    (name, {'wall': round(timing['wall'], 3),
+                            'cpu': round(timing['cpu'], 3),
+                            'calls': timing['calls']})
+                    for name, timing in self.phases.items()),
+                'counters': dict(self.counters),
+                'bytes_downloaded': self.bytes_downloaded,
+                'slowest_urls': [{'url': url, 'seconds': round(seconds, 3)}
+                                 for seconds, url in sorted(self._fetches,
+                                                            reverse=True)],
+                'failed_urls': [{'url': url, 'reason': reason}
+                                for url, reason in self._failures.items()],
+            }
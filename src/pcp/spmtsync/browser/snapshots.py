@@ -0,0 +1,206 @@
+import copy
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+
+from plone.registry.interfaces import IRegistry
+from zope.component import getUtility
+
+from pcp.spmtsync.browser import fetch
+from pcp.spmtsync.browser import utils
+
+
+logger = logging.getLogger('spmtsync')
+
+FORMAT = 'pcp.spmtsync.snapshot'
+VERSION = 1
+
+
+class Snapshot(object):
+    """The SPMT documents of a portfolio - the portfolio listing, contacts,
+    service details, components, implementations and implementation
+    details - keyed by the URL the sync reads them from.
+
+    Snapshots are stored as gzipped JSON lines: a header with the format
+    version, the portfolio URL, the creation time, a digest of the whole
+    content and the URLs that could not be fetched, followed by one line
+    per document holding its URL, fingerprint and payload.
+    """
+
+    def __init__(self, portfolio_url, documents, created=None, failed=(),
+                 fingerprints=None):
+        self.portfolio_url = portfolio_url
+        self.documents = documents
+        self.created = created or time.time()
+        self.failed = sorted(failed)
+        self._fingerprints = fingerprints
+
+    def services(self):
+        """Return (a copy of) the portfolio entries of the snapshot"""
+        portfolio = self.documents.get(self.portfolio_url, None)
+        if not portfolio:
+            return None
+        return copy.deepcopy(portfolio['services'])
+
+    def fingerprints(self):
+        """Return the mapping URL -> fingerprint of the documents"""
+        if self._fingerprints is None:
+            self._fingerprints = dict(
+                (url, utils.fingerprint(data))
+                for url, data in self.documents.items())
+        return self._fingerprints
+
+    @property
+    def digest(self):
+        return utils.fingerprint(sorted(self.fingerprints().items()))
+
+    def header(self):
+        return {
+            'format': FORMAT,
+            'version': VERSION,
+            'portfolio': self.portfolio_url,
+            'created': self.created,
+            'digest': self.digest,
+            'documents': len(self.documents),
+            'failed': self.failed,
+        }
+
+    def save(self, path):
+        """Write the snapshot to the file `path` (atomically)"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        fingerprints = self.fingerprints()
+        try:
+            with gzip.open(tmp, 'wb') as fp:
+                _writeline(fp, self.header())
+                for url in sorted(self.documents):
+                    _writeline(fp, {'url': url,
+                                    'fingerprint': fingerprints[url],
+                                    'data': self.documents[url]})
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        logger.info('Wrote snapshot of {} SPMT documents to {}'.format(
+            len(self.documents), path))
+
+    @classmethod
+    def load(cls, path):
+        """Read the snapshot from the file `path`"""
+        with gzip.open(path, 'rb') as fp:
+            header = _checkHeader(path, fp)
+            documents = {}
+            fingerprints = {}
+            for line in fp:
+                record = json.loads(line.decode('utf8'))
+                documents[record['url']] = record['data']
+                fingerprints[record['url']] = record['fingerprint']
+        return cls(header['portfolio'], documents, created=header['created'],
+                   failed=header['failed'], fingerprints=fingerprints)
+
+
+def _writeline(fp, record):
+    fp.write(json.dumps(record, sort_keys=True).encode('utf8') + b'\n')
+
+
+def _checkHeader(path, fp):
+    header = json.loads(fp.readline().decode('utf8') or '{}')
+    if header.get('format') != FORMAT:
+        raise ValueError('{} is not a SPMT snapshot'.format(path))
+    if header.get('version') != VERSION:
+        raise ValueError('{} has the unsupported snapshot version {}'.format(
+            path, header.get('version')))
+    return header
+
+
+def readHeader(path):
+    """Return the header of the snapshot file `path`"""
+    with gzip.open(path, 'rb') as fp:
+        return _checkHeader(path, fp)
+
+
+def readFingerprints(path):
+    """Return the mapping URL -> fingerprint of the snapshot file `path`"""
+    fingerprints = {}
+    with gzip.open(path, 'rb') as fp:
+        _checkHeader(path, fp)
+        for line in fp:
+            record = json.loads(line.decode('utf8'))
+            fingerprints[record['url']] = record['fingerprint']
+    return fingerprints
+
+
+def diffSnapshots(old_path, new_path):
+    """Return the URLs of the documents 'added', 'removed' and 'changed'
+    between the snapshot files `old_path` and `new_path`. Snapshots with
+    the same digest are compared by their headers only; if all lists are
+    empty there is nothing to sync."""
+    diff = {'added': [], 'removed': [], 'changed': []}
+    if readHeader(old_path)['digest'] == readHeader(new_path)['digest']:
+        return diff
+    old = readFingerprints(old_path)
+    new = readFingerprints(new_path)
+    diff['added'] = sorted(set(new) - set(old))
+    diff['removed'] = sorted(set(old) - set(new))
+    diff['changed'] = sorted(url for url in set(old) & set(new)
+                             if old[url] != new[url])
+    return diff
+
+
+def exportSnapshot(fetcher, portfolio_url):
+    """Fetch the complete SPMT graph below `portfolio_url` through
+    `fetcher` (a fetch.SPMTFetcher) and return it as Snapshot. Documents
+    that could not be fetched are left out and listed as failed."""
+    portfolio = fetcher.get(portfolio_url)
+    if not portfolio:
+        raise utils.SPMTFetchError(
+            'Could not fetch the SPMT portfolio from {}'.format(portfolio_url))
+    services = portfolio['services']
+    fetcher.fetch_all([fetch.contact_link(entry) for entry in services])
+    fetcher.prefetch(services)
+    documents = dict((url, data)
+                     for url, data in fetcher.documents().items()
+                     if url not in fetcher.failed)
+    return Snapshot(portfolio_url, documents, failed=fetcher.failed)
+
+
+def exportFromRegistry(concurrency=None, metrics=None):
+    """Return a Snapshot of the SPMT portfolio configured in the registry
+    (see `exportSnapshot` and fetch.fetcherFromRegistry)"""
+    registry = getUtility(IRegistry)
+    fetcher = fetch.fetcherFromRegistry(concurrency=concurrency)
+    fetcher.metrics = metrics
+    return exportSnapshot(fetcher, registry['pcp.spmtsync.portfoliourl'])
+
+
+class SnapshotFetcher(fetch.SPMTFetcher):
+    """A SPMTFetcher serving the documents of a Snapshot instead of
+    asking SPMT. Documents missing from the snapshot count as failed.
+    The sync modifies the documents it reads, so copies are handed out
+    and the snapshot can be synced more than once."""
+
+    def __init__(self, snapshot, metrics=None):
+        super(SnapshotFetcher, self).__init__(concurrency=1, metrics=metrics,
+                                              timeout=None, retries=0)
+        self.snapshot = snapshot
+
+    def get(self, url):
+        if url in self.snapshot.documents:
+            return copy.deepcopy(self.snapshot.documents[url])
+        if url not in self.failed:
+            self.record_failure(url, 'not in snapshot')
+        return None
+
+    def fetch_all(self, urls):
+        return [self.get(url) for url in urls if url]
+
+    def prefetch_details(self, details):
+        # the snapshot is in memory already
+        pass
+
+    def clear(self):
+        pass
@@ -1,7 +1,21 @@
 import deep
+import json
+import logging
+
+import transaction
+
+from AccessControl import getSecurityManager
+from Acquisition import aq_base
+from Acquisition import aq_parent
+from collections import OrderedDict
+
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+from ZODB.POSException import ConflictError
 
 from zope.interface import alsoProvides
 from zope.component import getUtility
+from zope.annotation.interfaces import IAnnotations
 
 import plone.api
 
@@ -11,12 +25,130 @@ from plone.protect.interfaces import IDisableCSRFProtection
 from Products.Five.browser import BrowserView
 from Products.PlonePAS.utils import cleanId
 from Products.CMFCore.utils import getToolByName
+from Products.CMFEditions.interfaces.IRepository import RepositoryPurgeError
+from Products.CMFEditions.Permissions import PurgeVersion
+
+try:
+    from Products.CMFCore.indexing import processQueue
+except ImportError:  # CMFCore < 2.4 reindexes right away
+    processQueue = None
 
 from pcp.spmtsync.browser import utils
 from pcp.spmtsync.browser import config
+from pcp.spmtsync.browser import fetch
+from pcp.spmtsync.browser import jobs
+from pcp.spmtsync.browser import log
+from pcp.spmtsync.browser import snapshots
+from pcp.spmtsync.browser.metrics import SyncMetrics
+
+
+logger = logging.getLogger('spmtsync')
+
+# annotation on the target folder: SPMT uuid -> fingerprint of the
+# SPMT payload last synced and of the documents listing its subtree
+FINGERPRINTS_KEY = 'pcp.spmtsync.fingerprints'
+
+# the SPMT documents listing the children of the nodes of a service tree:
+# level -> (URL of the listing for the node's data, children in the
+# listing, their level)
+SUBTREE = {
+    'details': (fetch.details_link, fetch.components_of, 'component'),
+    'component': (lambda data: fetch.related_link(
+                      data, 'service_component_implementations_link'),
+                  fetch.implementations_of, 'implementation'),
+    'implementation': (lambda data: fetch.related_link(
+                           data, 'component_implementation_details_link'),
+                       fetch.implementation_details_of, None),
+}
+
+# annotation on the target folder: SPMT uuid -> path of the synced object
+# relative to the target folder
+UUIDS_KEY = 'pcp.spmtsync.uuids'
+
+# annotation on the target folder: id -> fingerprint of the SPMT data of
+# the services committed per pass by a chunked sync that did not finish yet
+CHECKPOINT_KEY = 'pcp.spmtsync.checkpoint'
+
+# annotation on the target folder: metrics of the last sync as JSON
+METRICS_KEY = 'pcp.spmtsync.metrics'
+
+# annotation on the target folder: digest of the snapshot last synced
+# completely (see snapshots.Snapshot)
+SNAPSHOT_KEY = 'pcp.spmtsync.snapshot'
+
+
+def spmt_uid(obj):
+    """Return the SPMT uuid among the identifiers of `obj` or None"""
+    if getattr(aq_base(obj), 'getIdentifiers', None) is None:
+        return None
+    for identifier in obj.getIdentifiers() or []:
+        if identifier.get('type') == 'spmt_uid':
+            return identifier.get('value')
+    return None
+
+
+class PlannedObject(object):
+    """Stand-in for an object that a dry run (see `SPMTSyncView.plan`)
+    would create"""
+
+    def __init__(self, container, portal_type, id):
+        self.portal_type = portal_type
+        self.id = id
+        self.title = ''
+        self._path = tuple(container.getPhysicalPath()) + (id,)
+
+    def getPhysicalPath(self):
+        return self._path
+
+    def absolute_url(self, relative=0):
+        return '/'.join(self._path)
+
+    def getId(self):
+        return self.id
+
+    def Title(self):
+        return self.title
+
+    def UID(self):
+        return 'planned:' + '/'.join(self._path)
+
+    def getAdditional(self):
+        return []
+
+    def _getOb(self, id, default=None):
+        return default
+
 
+# field -> catalog indexes fed by it that neither have the name of the
+# field nor that of its accessor (see SPMTSyncView.apply_fields)
+DERIVED_INDEXES = {
+    'title': ('sortable_title',),
+    'effectiveDate': ('effective', 'effectiveRange', 'Date'),
+    'expirationDate': ('expires', 'effectiveRange'),
+    'language': ('Language',),
+}
 
-logger = utils.getLogger('var/log/spmtsync.log')
+
+class PendingMapping(object):
+    """Mapping reading through to `base` that collects the writes in
+    `changes` instead of storing them"""
+
+    def __init__(self, base):
+        self.base = base
+        self.changes = {}
+
+    def get(self, key, default=None):
+        if key in self.changes:
+            return self.changes[key]
+        return self.base.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def items(self):
+        merged = dict(self.base.items())
+        merged.update(self.changes)
+        return merged.items()
 
 
 class SPMTSyncView(BrowserView):
@@ -26,10 +158,289 @@ class SPMTSyncView(BrowserView):
         super(SPMTSyncView, self).__init__(context, request)
         self._objs_original = set()
         self._objs_touched = set()
+        self._objs_created = set()
+        self._objs_seen = set()
+        # paths objects were moved to by `relocate`
+        self._relocated = set()
+        # SPMT uuid -> uuids listed below it in this run (see `listings`)
+        self._listings = None
+        self._seeded = None
+        self._dirty = OrderedDict()
+        self._fetcher = None
+        self._contacts = None
+        self._incremental = False
+        self._keep_snapshots = False
+        self._unversioned = set()
+        self._max_versions = 0
+        self._commit_every = 0
+        # worker of a partitioned sync: the entries of the shared
+        # fingerprints and uuid index, written by the coordinator
+        self._pending = None
+        # service id or SPMT uuid -> UID of the Service
+        self._service_uids = {}
+        self.dependency_report = {'dangling': {}, 'cycles': []}
+        self.metrics = SyncMetrics()
+        # dictionary to report the progress to (see `report_progress`)
+        self.progress = None
+        # dry run (see `plan`): collect the changes instead of writing
+        self._dry_run = False
+        self._planned = {}
+        self._planned_deletions = set()
+        self.changes = {'create': [],
+                        'move': [],
+                        'update': [],
+                        'transition': [],
+                        'privatise': [],
+                        'delete': []}
+
+    def fetch(self, url):
+        """Return the SPMT payload from `url` - prefetched if possible"""
+        if self._fetcher is None:
+            self._fetcher = fetch.SPMTFetcher(metrics=self.metrics)
+        return self._fetcher.get(url)
+
+    def contacts(self, email2puid):
+        """Return the contact resolver of this sync run"""
+        if self._contacts is None:
+            if self._fetcher is None:
+                self._fetcher = fetch.SPMTFetcher(metrics=self.metrics)
+            self._contacts = fetch.ContactResolver(self._fetcher, email2puid)
+        return self._contacts
+
+    def skip_failed(self, url, obj):
+        """True if fetching `url` failed, in which case the existing
+        subtree of `obj` is kept as it is and not made private"""
+        if self._fetcher is None or url not in self._fetcher.failed:
+            return False
+        logger.warning("Keeping {} as it is - fetching '{}' failed".format(
+            '/'.join(obj.getPhysicalPath()), url))
+        self.metrics.count('skipped_subtrees')
+        self.touch_subtree(obj)
+        return True
+
+    def fingerprints(self):
+        """Return the persistent mapping SPMT uuid -> payload fingerprint"""
+        if self._pending is not None:
+            return self._pending['fingerprints']
+        annotations = IAnnotations(self.context)
+        if FINGERPRINTS_KEY not in annotations:
+            if self._dry_run:
+                return {}
+            annotations[FINGERPRINTS_KEY] = OOBTree()
+        return annotations[FINGERPRINTS_KEY]
+
+    def uuid_index(self):
+        """Return the persistent mapping SPMT uuid -> path of the synced
+        object relative to the target folder"""
+        if self._pending is not None:
+            return self._pending['uuids']
+        annotations = IAnnotations(self.context)
+        if UUIDS_KEY not in annotations:
+            if self._dry_run:
+                if self._seeded is None:
+                    self._seeded = self.seed_uuid_index({})
+                return self._seeded
+            annotations[UUIDS_KEY] = self.seed_uuid_index(OOBTree())
+        return annotations[UUIDS_KEY]
+
+    def seed_uuid_index(self, index):
+        """Fill the uuid `index` from the identifiers of the objects in the
+        target folder (once, for content synced before there was one)"""
+        base = '/'.join(self.context.getPhysicalPath())
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        brains = catalog.unrestrictedSearchResults(path=base)
+        for brain in sorted(brains, key=lambda brain: brain.getPath()):
+            path = brain.getPath()
+            if path == base:
+                continue
+            uuid = spmt_uid(brain._unrestrictedGetObject())
+            if uuid is not None and uuid not in index:
+                index[uuid] = path[len(base) + 1:]
+        logger.info('Indexed {} synced objects by SPMT uuid'.format(
+            len(index)))
+        return index
+
+    def indexed_object(self, uuid):
+        """Return the object indexed for the SPMT `uuid` or None"""
+        relative = self.uuid_index().get(uuid)
+        if relative is None:
+            return None
+        return self.lookup(relative)
+
+    def lookup(self, relative):
+        """Return the object at the path `relative` to the target folder
+        or None (without acquiring anything)"""
+        obj = self.context
+        for id in relative.split('/'):
+            obj = obj._getOb(id, None)
+            if obj is None:
+                return None
+        return obj
+
+    def index_uuid(self, uuid, path):
+        """Remember the object at `path` for the SPMT `uuid` unless the
+        index holds another object that still exists (a uuid synced to
+        several places keeps its first one)"""
+        if self._dry_run:
+            return
+        index = self.uuid_index()
+        relative = path[len('/'.join(self.context.getPhysicalPath())) + 1:]
+        current = index.get(uuid)
+        if current == relative:
+            return
+        if current is not None and self.indexed_object(uuid) is not None:
+            return
+        index[uuid] = relative
+
+    def relocate(self, container, portal_type, obj_id, uuid):
+        """Return the object indexed for the SPMT `uuid`, renamed to `obj_id`
+        and moved into `container`, or None if there is none to move (or
+        its old parent still lists it)"""
+        obj = self.indexed_object(uuid)
+        if obj is None or obj.portal_type != portal_type:
+            return None
+        parent = aq_parent(obj)
+        if aq_base(parent) is not aq_base(container):
+            listed = self.listed(parent)
+            if listed is None or uuid in listed:
+                # still there - shared by several parents
+                return None
+        old = '/'.join(obj.getPhysicalPath())
+        new = '/'.join(container.getPhysicalPath()) + '/' + obj_id
+        if old in self._objs_seen or new.startswith(old + '/'):
+            return None
+        if [deleted for deleted in self._planned_deletions
+                if old == deleted or old.startswith(deleted + '/')]:
+            return None
+        if self._dry_run:
+            self.changes['move'].append({'from': old, 'to': new})
+            return obj
+        if aq_base(aq_parent(obj)) is aq_base(container):
+            plone.api.content.rename(obj=obj, new_id=obj_id)
+        else:
+            plone.api.content.move(source=obj, target=container, id=obj_id)
+        self.moved(old, new)
+        self._relocated.add(new)
+        self.metrics.count('moved')
+        logger.info('Moved %s to %s (renamed in SPMT)', old, new)
+        return container._getOb(obj_id)
+
+    def listed(self, parent):
+        """Return the SPMT uuids listed below `parent` in this run's data
+        or None if that is incomplete (streaming or partial syncs)"""
+        if self._listings is None:
+            return None
+        return self._listings.get(spmt_uid(parent), ())
+
+    def collect_listings(self, entries):
+        """Record the SPMT uuids listed below the nodes of the service trees
+        of the portfolio `entries` in the fetched documents (a Service
+        holds both its details and their components)"""
+        self._listings = {}
+        for entry in entries:
+            listed = self._listings.setdefault(entry['uuid'], set())
+            for data in entry['service_details_list']['service_details'][:1]:
+                listed.add(data['uuid'])
+                self.collect_listing(entry['uuid'], data, 'details')
+
+    def collect_listing(self, uuid, data, level):
+        """Record the children listed for `data` at `level` below `uuid`"""
+        link, children, below = SUBTREE[level]
+        listing = self._fetcher.fetch_all([link(data)])
+        listed = self._listings.setdefault(uuid, set())
+        for child in children(listing and listing[0]):
+            listed.add(child['uuid'])
+            if below is not None:
+                self.collect_listing(child['uuid'], child, below)
+
+    def moved(self, old, new):
+        """Update the uuid index and the objects existing before the sync
+        after the subtree at `old` got moved to `new`"""
+        base = len('/'.join(self.context.getPhysicalPath())) + 1
+        old_relative, new_relative = old[base:], new[base:]
+        index = self.uuid_index()
+        for uuid, relative in list(index.items()):
+            if relative == old_relative or \
+                    relative.startswith(old_relative + '/'):
+                index[uuid] = new_relative + relative[len(old_relative):]
+        prefix = old + '/'
+        for path in [p for p in self._objs_original
+                     if p == old or p.startswith(prefix)]:
+            self._objs_original.discard(path)
+            self._objs_original.add(new + path[len(old):])
+
+    def is_known(self, data):
+        """True if `data` has been synced unchanged before"""
+        fingerprint = utils.fingerprint(data)
+        return self.fingerprints().get(data['uuid']) == fingerprint
+
+    def is_unchanged(self, obj, fingerprint, uuid, subtree=True):
+        """In incremental mode: True if the SPMT payload of `obj` did not
+        change since the last sync, marking `obj` (and its subtree if
+        `subtree` is set) as touched"""
+        if not self._incremental:
+            return False
+        path = '/'.join(obj.getPhysicalPath())
+        if path in self._objs_created or self.below_relocated(path):
+            return False
+        if fingerprint is None or self.fingerprints().get(uuid) != fingerprint:
+            return False
+        self.metrics.count('unchanged')
+        if subtree:
+            self.touch_subtree(obj)
+        logger.debug('Unchanged %s/%s - skipping', obj.portal_type,
+                     obj.getId())
+        return True
+
+    def subtree_fingerprint(self, data, level=None):
+        """Return a fingerprint of the SPMT `data` of a node at `level` (see
+        SUBTREE) and of the documents listing the nodes below it, or None
+        if one of them could not be fetched"""
+        fingerprint = utils.fingerprint(data)
+        if level is None:
+            return fingerprint
+        link, children, below = SUBTREE[level]
+        url = link(data)
+        listing = self.fetch(url)
+        if url in self._fetcher.failed:
+            return None
+        parts = [fingerprint]
+        for child in children(listing):
+            part = self.subtree_fingerprint(child, below)
+            if part is None:
+                return None
+            parts.append(part)
+        return utils.fingerprint(parts)
+
+    def below_relocated(self, path):
+        """True if `path` is below an object moved during this sync, whose
+        titles and descriptions are derived from the old name"""
+        return bool(self._relocated) and bool(
+            [moved for moved in self._relocated
+             if path.startswith(moved + '/')])
+
+    def record_fingerprint(self, fingerprint, uuid):
+        """Remember `fingerprint` after the subtree of `uuid` got synced"""
+        if self._dry_run:
+            return
+        fingerprints = self.fingerprints()
+        if fingerprints.get(uuid) != fingerprint:
+            fingerprints[uuid] = fingerprint
+
+    def touch_subtree(self, obj):
+        """Mark `obj` and everything below it as still present in SPMT"""
+        self.touch_path('/'.join(obj.getPhysicalPath()))
+
+    def touch_path(self, path):
+        """Mark `path` and everything below it as still present in SPMT"""
+        prefix = path + '/'
+        self._objs_touched.add(path)
+        self._objs_touched.update(p for p in self._objs_original
+                                  if p.startswith(prefix))
 
     def prepare_data(self, values, additional_org, email2puid, logger):
 
-        logger.debug(values)
+        logger.debug('%s', log.Payload(values))
 
         fields = values.copy()
 
@@ -48,22 +459,14 @@ class SPMTSyncView(BrowserView):
         fields['service_complete_link'] = scl
         fields['identifiers'] = identifiers
         # link contacts
-        contact_info = fields['contact_information']
-        if contact_info is not None:
-            contact_url = fields['contact_information']['links']['self']
-            # first map exceptions
-            contact_data = utils.getDataFromSPMT(contact_url)
-            try:
-                contact_email = contact_data[
-                    'external_contact_information']['email']
-            except TypeError:
-                contact_email = 'noreply@nowhere.org'
-            email = config.creg2dp_email.get(contact_email, contact_email)
-            # then look up corresponding UID
-            contact_uid = email2puid.get(email, None)
+        contact_url = fetch.contact_link(fields)
+        if contact_url is not None:
+            # look up the corresponding UID (exceptions are mapped already)
+            contact_email, contact_uid = \
+                self.contacts(email2puid).resolve(contact_url)
             if contact_uid is None:
-                logger.warning("'%s' not found - no contact set for '%s'"
-                               % (contact_email, title))
+                logger.warning("'%s' not found - no contact set for '%s'",
+                               contact_email, title)
             else:
                 fields['contact'] = contact_uid
         # same for the service owner
@@ -71,15 +474,14 @@ class SPMTSyncView(BrowserView):
             owner_email = fields['service_owner']['email']
         except TypeError:
             owner_email = "noreply@nowhere.org"
-        o_email = config.creg2dp_email.get(owner_email, owner_email)
-        owner_uid = email2puid.get(o_email, None)
+        owner_uid = email2puid.get(owner_email.lower(), None)
         if owner_uid is None:
-            logger.warning("'%s' not found - no service owner set for '%s'"
-                           % (owner_email, title))
+            logger.warning("'%s' not found - no service owner set for '%s'",
+                           owner_email, title)
         else:
             fields['service_owner'] = owner_uid
 
-        return fields.copy()
+        return fields
 
     def flatten_links(self, data):
         """Unpack and inline the embedded links"""
@@ -90,82 +492,299 @@ class SPMTSyncView(BrowserView):
         data['links'] = details_link
         return data
 
+    def index_services(self):
+        """Index the UIDs of the Services already in the target folder"""
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        for brain in catalog.unrestrictedSearchResults(
+                portal_type='Service',
+                path={'query': '/'.join(self.context.getPhysicalPath()),
+                      'depth': 1}):
+            self._service_uids[brain.getId] = brain.UID
+
+    def lookup_service_uid(self, dep):
+        """Return the UID of the Service referenced by the dependency `dep`
+        or None"""
+        uid = self._service_uids.get(dep['service'].get('uuid'), None)
+        if uid is None:
+            uid = self._service_uids.get(cleanId(dep['service']['name']), None)
+        return uid
+
+    def check_dependencies(self, details):
+        """Report dangling dependencies and dependency cycles among the
+        service `details` (a list of (service id, details data) pairs)"""
+        self.dependency_report = utils.checkDependencies(
+            details, lambda dep: cleanId(dep['service']['name']),
+            lambda dep: self.lookup_service_uid(dep) is not None)
+        return self.dependency_report
+
     def resolveDependencies(self, data):
         """Resolve dependencies by looking up the UIDs of the respective
-        services. It is assumed that the services are there and can be
-        looked up by name in the target folder."""
+        services in the index built during the first pass (see
+        `index_services` and `sync_service`)."""
 
-        site = plone.api.portal.get()
         deps = data['dependencies_list']['services']
         if not deps:
             data['dependencies'] = []
         else:
             dependencies = []
             for dep in deps:
-                name = dep['service']['name']
-                try:
-                    uid = self.context[cleanId(name)].UID()
+                uid = self.lookup_service_uid(dep)
+                if uid is not None:
                     dependencies.append(uid)
-                except KeyError:  # can happen on first pass
-                    pass
             data['dependencies'] = dependencies
         return data
 
+    def log_changes(self, obj, last_digests, digests, data):
+        """Log which top-level keys of `data` changed (with a diff if the
+        previous `data` has been kept as `_last_saved_data`)"""
+        last_digests = last_digests or {}
+        changed = sorted(key for key in set(last_digests) | set(digests)
+                         if last_digests.get(key) != digests.get(key))
+        logger.info('Changed %s/%s: %s', obj.portal_type, obj.getId(),
+                    ', '.join(changed))
+        last_saved_data = getattr(obj, '_last_saved_data', None)
+        if last_saved_data is None:
+            return
+        for key in changed:
+            diff = deep.diff(last_saved_data.get(key), data.get(key))
+            if diff:
+                logger.info('Diff of %s: %s', key, diff.print_full())
+
+    def apply_fields(self, obj, data, keys):
+        """Set the fields `keys` of `obj` from `data` the way the
+        Archetypes edit() method (Schema.updateAll) does - but without
+        reindexing. Return the names of the catalog indexes possibly
+        affected."""
+        schema = obj.Schema()
+        idxs = set()
+        for key in keys:
+            field = schema.get(key, None)
+            if field is None or 'w' not in field.mode:
+                continue
+            mutator = field.getMutator(obj)
+            if mutator is None:
+                logger.warning('No mutator for %s of %s/%s', key,
+                               obj.portal_type, obj.getId())
+                continue
+            mutator(data[key])
+            idxs.add(key)
+            if field.accessor:
+                idxs.add(field.accessor)
+            idxs.update(DERIVED_INDEXES.get(key, ()))
+            if getattr(field, 'searchable', False):
+                idxs.add('SearchableText')
+        return idxs
+
+    def mark_dirty(self, obj, idxs=None):
+        """Schedule `obj` for reindexing at the end of the sync.
+        `idxs=None` asks for a full reindex."""
+        path = '/'.join(obj.getPhysicalPath())
+        if path in self._objs_created:
+            idxs = None
+        if path in self._dirty:
+            scheduled = self._dirty[path][1]
+            if scheduled is None or idxs is None:
+                idxs = None
+            else:
+                idxs = scheduled | set(idxs)
+        elif idxs is not None:
+            idxs = set(idxs)
+        self._dirty[path] = (obj, idxs)
+
+    def reindex_dirty(self):
+        """Reindex every object changed during the sync exactly once,
+        restricted to the indexes fed by the fields that changed"""
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        available = set(catalog.indexes())
+        with self.metrics.phase('reindex'):
+            for obj, idxs in self._dirty.values():
+                if idxs is None:
+                    obj.reindexObject()
+                    continue
+                obj.notifyModified()
+                idxs = (idxs & available) | set(['modified'])
+                obj.reindexObject(idxs=sorted(idxs))
+        logger.debug('Reindexed %d objects', len(self._dirty))
+        self.metrics.count('reindexed', len(self._dirty))
+        self._dirty.clear()
+
+    def plan_update(self, obj, last_digests, digests, data):
+        """Dry run: record the changed fields `update_object` would set"""
+        path = '/'.join(obj.getPhysicalPath())
+        if path in self._planned:
+            obj.title = data.get('title', '')
+            return
+        last_digests = last_digests or {}
+        last_saved_data = getattr(obj, '_last_saved_data', None)
+        schema = obj.Schema()
+        fields = {}
+        for key in digests:
+            if last_digests.get(key) == digests[key]:
+                continue
+            fields[key] = {'new': data[key]}
+            field = schema.get(key, None)
+            if field is not None:
+                # the current value - the SPMT data is only kept optionally
+                accessor = field.getAccessor(obj)
+                fields[key]['old'] = accessor() if accessor is not None \
+                    else field.get(obj)
+            elif last_saved_data is not None:
+                fields[key]['old'] = last_saved_data.get(key, None)
+        self.changes['update'].append({'path': path,
+                                       'portal_type': obj.portal_type,
+                                       'fields': fields})
+
     def update_object(self, obj, data):
-        """ Update `obj` with data dict using Archetypes edit() method.
-            We preserve the original `data` dictionary in order to check
-            during later updates for changed data in order to avoid
-            unneccessary copy of the same object in portal_repository.
+        """ Update the changed fields of `obj` from the data dict and save a
+            version unless only unversioned fields changed.
         """
 
-        last_saved_data = getattr(obj, '_last_saved_data', None)
+        digests = dict((key, utils.fingerprint(value))
+                       for key, value in data.items())
+        digest = utils.fingerprint(digests)
 
-        if last_saved_data != data:
+        last_digest = getattr(obj, '_last_saved_digest', None)
+        last_digests = getattr(obj, '_last_saved_digests', None)
+        if last_digest is None:
+            # objects synced before digests were introduced
+            last_saved_data = getattr(obj, '_last_saved_data', None)
+            if last_saved_data is not None:
+                last_digests = dict((key, utils.fingerprint(value))
+                                    for key, value in last_saved_data.items())
+                last_digest = utils.fingerprint(last_digests)
 
-            diff = deep.diff(last_saved_data, data)
-            if diff:
-                logger.info('Diff: {}'.format(diff.print_full()))
+        if last_digest != digest:
 
-            obj.edit(**data)
-            obj.reindexObject()
-            obj._last_saved_data = data
+            if self._dry_run:
+                self.plan_update(obj, last_digests, digests, data)
+                return
 
-            portal_repo = plone.api.portal.get_tool('portal_repository')
-            portal_repo.save(obj=obj, comment='Synchronization from SPMT')
+            if logger.isEnabledFor(logging.INFO):
+                self.log_changes(obj, last_digests, digests, data)
+
+            if last_digests is None:
+                changed = list(data.keys())
+            else:
+                changed = [key for key in digests
+                           if last_digests.get(key) != digests[key]]
+            with self.metrics.phase('edit'):
+                self.mark_dirty(obj, self.apply_fields(obj, data, changed))
+            obj._last_saved_digest = digest
+            obj._last_saved_digests = digests
+            if self._keep_snapshots:
+                obj._last_saved_data = data
+            elif getattr(obj, '_last_saved_data', None) is not None:
+                del obj._last_saved_data
+
+            if last_digests is not None and \
+                    not set(changed) - self._unversioned:
+                self.metrics.count('unversioned')
+            else:
+                self.save_version(obj)
 
-            logger.info(
-                "Updated {}/{} in the 'catalog' folder".format(obj.portal_type, obj.getId()))
+            self.metrics.count('updated')
+            logger.info('Updated %s/%s', obj.portal_type, obj.getId())
         else:
-            logger.debug('Up2date {}/{}'.format(obj.portal_type, obj.getId()))
+            self.metrics.count('up_to_date')
+            logger.debug('Up2date %s/%s', obj.portal_type, obj.getId())
+
+    def save_version(self, obj):
+        """Save a version of `obj` in portal_repository, keeping at most
+        the number of versions set in 'pcp.spmtsync.max_versions'"""
+        portal_repo = plone.api.portal.get_tool('portal_repository')
+        with self.metrics.phase('versioning'):
+            portal_repo.save(obj=obj, comment='Synchronization from SPMT')
+            if self._max_versions:
+                self.purge_versions(portal_repo, obj)
+
+    def purge_versions(self, portal_repo, obj):
+        """Purge the oldest versions of `obj` beyond `_max_versions`"""
+        if not getSecurityManager().checkPermission(PurgeVersion, obj):
+            logger.warning("The user running the sync may not purge "
+                           "versions - keeping all")
+            self._max_versions = 0
+            return
+        history = portal_repo.getHistoryMetadata(obj)
+        if not history:
+            return
+        excess = history.getLength(countPurged=False) - self._max_versions
+        try:
+            for i in range(excess):
+                # with countPurged=False selector 0 is the oldest version
+                # that is not purged yet
+                portal_repo.purge(obj, 0, comment='Pruned by the SPMT sync',
+                                  countPurged=False)
+        except RepositoryPurgeError as exc:
+            logger.warning('Versions cannot be purged - keeping all: '
+                           '{}'.format(exc))
+            self._max_versions = 0
+            return
+        if excess > 0:
+            self.metrics.count('versions_purged', excess)
 
-    def check_and_create_object(self, container, portal_type, obj_id):
-        """ Check if `container` contains an object with ID `obj_id`.
-            If not, create it and return it.
+    def check_and_create_object(self, container, portal_type, obj_id,
+                                uuid=None):
+        """ Check if `container` contains an object with ID `obj_id` (or
+            the SPMT `uuid`, see `relocate`). If not, create it and return it.
         """
-        if obj_id not in container.objectIds():
+        path = '/'.join(container.getPhysicalPath()) + '/' + obj_id
+        if path in self._planned:
+            return self._planned[path]
+        if path in self._objs_seen:
+            return container._getOb(obj_id)
+
+        obj = None
+        if path not in self._planned_deletions:
+            obj = container._getOb(obj_id, None)
+        if obj is None and uuid is not None:
+            obj = self.relocate(container, portal_type, obj_id, uuid)
+            if obj is not None and self._dry_run:
+                # the planned move keeps the existing subtree
+                self._planned[path] = obj
+                path = '/'.join(obj.getPhysicalPath())
+        if obj is None and self._dry_run:
+            obj = self._planned[path] = PlannedObject(
+                container, portal_type, obj_id)
+            self.changes['create'].append({'path': path,
+                                           'portal_type': portal_type})
+            self._objs_created.add(path)
+            self._objs_touched.add(path)
+            return obj
+        if obj is None:
             obj = plone.api.content.create(
                 type=portal_type,
                 container=container,
                 id=obj_id)
-            logger.info('Adding {}/{} to "{}/{}/{}"'.format(portal_type, obj_id,
-                                                            container.portal_type, container.absolute_url(1), container.Title()))
-
-        obj = container[obj_id]
+            self._objs_created.add(path)
+            self.metrics.count('created')
+            logger.info('Adding %s/%s to "%s/%s"', portal_type, obj_id,
+                        container.portal_type, container.absolute_url(1))
+        if uuid is not None:
+            self.index_uuid(uuid, path)
 
-        self._objs_touched.add('/'.join(obj.getPhysicalPath()))
+        self._objs_touched.add(path)
+        self._objs_seen.add(path)
 
-        if plone.api.content.get_state(obj) != 'internally_published':
+        state = plone.api.content.get_state(obj)
+        if state != 'internally_published':
+            if self._dry_run:
+                self.changes['transition'].append(
+                    {'path': path, 'from': state, 'to': 'internally_published'})
+                return obj
+            # the workflow tool reindexes the workflow variables itself
             plone.api.content.transition(obj=obj, to_state='internally_published')
-            obj.reindexObject()
         return obj
 
     def addImplementationDetails(self, impl, data, logger):
         """Adding implementation details to a service component implementation"""
-        logger.debug(
-            "addImplemenationDetails called with this data: '%s'" % data)
+        logger.debug("addImplemenationDetails called with this data: '%s'",
+                     log.Payload(data))
+        fingerprint = utils.fingerprint(data)
         id = cleanId('version-' + data['version'])
         details = self.check_and_create_object(
-            impl, 'ServiceComponentImplementationDetails', id)
+            impl, 'ServiceComponentImplementationDetails', id, data['uuid'])
+        if self.is_unchanged(details, fingerprint, data['uuid']):
+            return
 
         data['title'] = 'Version ' + data['version']
         data['description'] = 'Implementation details of ' + \
@@ -182,13 +801,18 @@ class SPMTSyncView(BrowserView):
             data['configuration_parameters'] = []
 
         self.update_object(details, data)
+        self.record_fingerprint(fingerprint, data['uuid'])
 
     def addImplementation(self, component, data, logger):
         """Adding an implementation to a service component"""
-        logger.debug("addImplemenation called with this data: '%s'" % data)
+        logger.debug("addImplemenation called with this data: '%s'",
+                     log.Payload(data))
+        fingerprint = self.subtree_fingerprint(data, 'implementation')
         id = cleanId(data['name'])
         implementation = self.check_and_create_object(
-            component, 'ServiceComponentImplementation', id)
+            component, 'ServiceComponentImplementation', id, data['uuid'])
+        if self.is_unchanged(implementation, fingerprint, data['uuid']):
+            return
 
         data['title'] = component.Title() + ' implementation: ' + data['name']
         data['identifiers'] = [{'type': 'spmt_uid',
@@ -197,23 +821,30 @@ class SPMTSyncView(BrowserView):
 
         self.update_object(implementation, data)
 
-        details_data = utils.getDataFromSPMT(
-            data['component_implementation_details_link']['related']['href'])
-        details = details_data['service_component_implementation_details_list'][
-            'service_component_implementation_details']
+        details_url = fetch.related_link(
+            data, 'component_implementation_details_link')
+        details_data = self.fetch(details_url)
+        if self.skip_failed(details_url, implementation):
+            return
+        details = fetch.implementation_details_of(details_data)
         if not details:
-            logger.info("No implemenation details found for '%s'" %
+            logger.info("No implemenation details found for '%s'",
                         data['title'])
-            return
         for detail in details:
             self.addImplementationDetails(implementation, detail, logger)
+        if details_data is not None:
+            self.record_fingerprint(fingerprint, data['uuid'])
 
     def addComponent(self, service, data, logger):
         """Adding a service component to 'service' described by 'data'"""
-        logger.debug("addComponent called with this data: '%s'" % data)
+        logger.debug("addComponent called with this data: '%s'",
+                     log.Payload(data))
+        fingerprint = self.subtree_fingerprint(data, 'component')
         id = cleanId(data['name'])
         component = self.check_and_create_object(
-            service, 'ServiceComponent', id)
+            service, 'ServiceComponent', id, data['uuid'])
+        if self.is_unchanged(component, fingerprint, data['uuid']):
+            return
 
         data['title'] = "Service component '%s'" % data['name']
         data['identifiers'] = [{'type': 'spmt_uid',
@@ -222,111 +853,608 @@ class SPMTSyncView(BrowserView):
 
         self.update_object(component, data)
 
-        implementations_data = utils.getDataFromSPMT(
-            data['service_component_implementations_link']['related']['href'])
-        # print "#############\n", implementations_data
+        implementations_url = fetch.related_link(
+            data, 'service_component_implementations_link')
+        implementations_data = self.fetch(implementations_url)
+        if self.skip_failed(implementations_url, component):
+            return
         if not implementations_data:
-            logger.info("No implemenations_data found for '%s'" % data['title'])
+            logger.info("No implemenations_data found for '%s'", data['title'])
             return
-        implementations = implementations_data[
-            'service_component_implementations_list']['service_component_implementations']
+        implementations = fetch.implementations_of(implementations_data)
         if not implementations:
-            logger.info("No implemenations found for '%s'" % data['title'])
-            return
+            logger.info("No implemenations found for '%s'", data['title'])
         for implementation in implementations:
             self.addImplementation(component, implementation, logger)
+        self.record_fingerprint(fingerprint, data['uuid'])
 
-    def addDetails(self, parent, data, logger):
-        """Adding service details"""
-
-        details = self.check_and_create_object(
-            parent, 'Service Details', 'details')
-
+    def details_fields(self, data):
+        """Return the fields of the Service Details for the SPMT `data`"""
         data = self.flatten_links(data)
         data = self.resolveDependencies(data)
         data['identifiers'] = [{'type': 'spmt_uid',
                                 'value': data['uuid']},
                                ]
+        return data
+
+    def addDetails(self, parent, data, logger):
+        """Adding service details"""
+
+        fingerprint = self.details_fingerprint(data)
+        details = self.check_and_create_object(
+            parent, 'Service Details', 'details', data['uuid'])
+        if self.is_unchanged(details, fingerprint, data['uuid'],
+                             subtree=False):
+            # the components live next to the details, on the Service
+            self.touch_subtree(parent)
+            return None
 
+        data = self.details_fields(data)
         self.update_object(details, data)
 
         # adding service components if any
-        full_data = utils.getDataFromSPMT(data['links']) or {}
+        full_data = self.fetch(data['links'])
+        if self.skip_failed(data['links'], parent):
+            return None
+        if full_data is None:
+            return None
         scl = full_data.get('service_components_list', None)
         if scl is None:
-            logger.debug('No service components found for %s' % parent.Title())
+            logger.debug('No service components found for %s', parent.Title())
+        for component in fetch.components_of(full_data):
+            self.addComponent(parent, component, logger)
+        self.record_fingerprint(fingerprint, data['uuid'])
+
+    def service_id(self, entry):
+        """Return the id of the Service for the portfolio `entry` or None
+        if the entry is not to be synced"""
+        id = cleanId(entry['name'])
+        if id == 'test':
             return None
-        for sc in scl['service_components']:
-            self.addComponent(parent, sc['component'], logger)
+        if id is None:
+            logger.warning("Couldn't generate id for '%s'" % entry['name'])
+        return id
+
+    def iter_services(self, entries, details):
+        """Yield (service id, entry) for the portfolio `entries` that are to
+        be synced and collect their (service id, service details) pairs in
+        the list `details`"""
+        for entry in entries:
+            id = self.service_id(entry)
+            if id is None:
+                continue
+            # we assume there is at most one
+            for data in entry['service_details_list']['service_details'][:1]:
+                details.append((id, data))
+            yield id, entry
+
+    def with_contacts(self, services, chunk_size):
+        """Yield the (service id, entry) pairs of `services` after
+        prefetching the contacts of `chunk_size` entries at a time"""
+        for chunk in utils.chunked(services, chunk_size):
+            self.prefetch_contacts([entry for id, entry in chunk])
+            for item in chunk:
+                yield item
+
+    def prefetch_contacts(self, entries):
+        """Fetch the contacts of the portfolio `entries` to be updated"""
+        if self._incremental:
+            entries = [entry for entry in entries if not self.is_known(entry)]
+        with self.metrics.phase('fetch'):
+            self._contacts.prefetch(entries)
+
+    def prefetched(self, details, chunk_size):
+        """Yield the (service id, service details) pairs of `details`
+        after prefetching their subtrees `chunk_size` services at a time,
+        keeping only the current chunk's documents in memory"""
+        for chunk in utils.chunked(details, chunk_size):
+            self._fetcher.clear()
+            with self.metrics.phase('fetch'):
+                self._fetcher.prefetch_details([data for id, data in chunk])
+            for item in chunk:
+                yield item
+
+    def sync_service(self, id, entry, email2puid):
+        """First pass: create or update the Service for `entry`"""
+        service = self.check_and_create_object(self.context, 'Service', id,
+                                               entry['uuid'])
+        self._service_uids[id] = self._service_uids[entry['uuid']] = \
+            service.UID()
+        fingerprint = utils.fingerprint(entry)
+        if self.is_unchanged(service, fingerprint, entry['uuid'],
+                             subtree=False):
+            return
+
+        # retrieve data to extended rather than overwrite
+        additional = service.getAdditional()
+        with self.metrics.phase('prepare_data'):
+            data = self.prepare_data(entry, additional, email2puid, logger)
+        self.update_object(service, data)
+        self.record_fingerprint(fingerprint, entry['uuid'])
+
+    def details_fingerprint(self, data):
+        """Return the fingerprint of the service details `data` and their
+        subtree (see `subtree_fingerprint`)"""
+        return self.subtree_fingerprint(data, 'details')
+
+    def sync_details(self, id, data):
+        """Second pass: sync the details subtree of the Service `id`"""
+        path = '/'.join(self.context.getPhysicalPath()) + '/' + id
+        service = self._planned.get(path, None) or self.context._getOb(id)
+        self.addDetails(service, data, logger)
+
+    def commit(self, note):
+        """Commit the work done so far and release cached objects"""
+        self.reindex_dirty()
+        with self.metrics.phase('commit'):
+            txn = transaction.get()
+            txn.note(note)
+            txn.commit()
+            self.context._p_jar.cacheGC()
+
+    def report_progress(self, error=None, **progress):
+        """Update the `progress` dictionary of a background sync job
+        (see jobs.startSyncJob) and record `error` there"""
+        if self.progress is None:
+            return
+        self.progress.update(progress)
+        if error is not None:
+            self.progress['errors'].append(error)
+
+    def run_pass(self, name, items, handler, subtree=True, total=None,
+                 digest=utils.fingerprint):
+        """Call `handler(id, data)` for all (service id, data) pairs in
+        `items`; with `commit_every` in savepoints, committing in chunks
+        and resuming from a checkpoint of `digest(data)`"""
+        base_path = '/'.join(self.context.getPhysicalPath())
+        if total is None and hasattr(items, '__len__'):
+            total = len(items)
+        self.report_progress(**{'pass': name, 'done': 0, 'total': total})
+        if not self._commit_every:
+            for done, (id, data) in enumerate(items, 1):
+                handler(id, data)
+                self.report_progress(done=done)
+            return
+
+        annotations = IAnnotations(self.context)
+        if CHECKPOINT_KEY not in annotations:
+            annotations[CHECKPOINT_KEY] = PersistentMapping()
+        checkpoint = annotations[CHECKPOINT_KEY]
+        if not isinstance(checkpoint.get(name), OOBTree):
+            # none yet or one without fingerprints
+            checkpoint[name] = OOBTree()
+        done = checkpoint[name]
+        if len(done):
+            logger.info('Resuming {} pass after {} services'.format(
+                name, len(done)))
+
+        pending = 0
+        for count, (id, data) in enumerate(items, 1):
+            self.report_progress(done=count)
+            path = base_path + '/' + id
+            fingerprint = digest(data)
+            if fingerprint is not None and done.get(id) == fingerprint:
+                if subtree:
+                    self.touch_path(path)
+                else:
+                    self._objs_touched.add(path)
+                continue
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                handler(id, data)
+            except ConflictError:
+                raise
+            except Exception:
+                logger.exception("Syncing '{}' failed ({} pass) - "
+                                 "rolled back".format(id, name))
+                self.metrics.count('failed')
+                self.report_progress(
+                    error="Syncing '{}' failed ({} pass)".format(id, name))
+                savepoint.rollback()
+                for dirty in list(self._dirty):
+                    if dirty == path or dirty.startswith(path + '/'):
+                        del self._dirty[dirty]
+                self._objs_seen = set(
+                    seen for seen in self._objs_seen
+                    if not (seen == path or seen.startswith(path + '/')))
+                self.forget_rolled_back(id, path)
+                self.touch_path(path)
+                continue
+            done[id] = fingerprint
+            pending += 1
+            if pending >= self._commit_every:
+                self.commit('SPMT sync: {} pass, {} services'.format(
+                    name, len(done)))
+                pending = 0
+        if pending:
+            self.commit('SPMT sync: {} pass, {} services'.format(
+                name, len(done)))
+
+    def forget_rolled_back(self, id, path):
+        """Forget the objects below `path` whose creation got rolled back,
+        including the UID of the Service `id` if it was one of them"""
+        base = len('/'.join(self.context.getPhysicalPath())) + 1
+        gone = set(created for created in self._objs_created
+                   if (created == path or created.startswith(path + '/'))
+                   and self.lookup(created[base:]) is None)
+        self._objs_created -= gone
+        if path in gone:
+            uid = self._service_uids.pop(id, None)
+            for key in [key for key, value in self._service_uids.items()
+                        if value == uid]:
+                del self._service_uids[key]
 
-    def sync(self, force=False):
+    def configure(self, incremental=False, commit_every=None,
+                  concurrency=None, snapshot=None):
+        """Set up logging, the options of this sync run from the registry
+        and the fetcher (see `sync` for the arguments)"""
+        registry = getUtility(IRegistry)
+        log.configureLogging(
+            registry.get('pcp.spmtsync.logfile', 'var/log/spmtsync.log'),
+            level=registry.get('pcp.spmtsync.loglevel', 'INFO'),
+            sample=registry.get('pcp.spmtsync.log_sample', 1))
+        self._incremental = bool(incremental)
+        self._unversioned = set(
+            registry.get('pcp.spmtsync.unversioned_fields', None) or ())
+        self._max_versions = registry.get('pcp.spmtsync.max_versions', 0) or 0
+        self._keep_snapshots = registry.get('pcp.spmtsync.keep_snapshots',
+                                            False)
+        if commit_every is None:
+            commit_every = registry.get('pcp.spmtsync.commit_every', 0)
+        self._commit_every = int(commit_every or 0)
+        if snapshot is not None:
+            if not isinstance(snapshot, snapshots.Snapshot):
+                raise TypeError('snapshot must be a snapshots.Snapshot')
+            self._fetcher = snapshots.SnapshotFetcher(snapshot,
+                                                      metrics=self.metrics)
+        else:
+            self._fetcher = fetch.fetcherFromRegistry(concurrency=concurrency)
+            self._fetcher.metrics = self.metrics
+
+    def portfolio(self, snapshot=None):
+        """Return the portfolio entries from SPMT or the `snapshot`"""
+        with self.metrics.phase('fetch'):
+            if snapshot is not None:
+                entries = snapshot.services()
+            else:
+                entries = utils.getServiceData(
+                    session=self._fetcher.session,
+                    cache=self._fetcher.cache, metrics=self.metrics,
+                    timeout=self._fetcher.timeout,
+                    retries=self._fetcher.retries)
+        if entries is None:
+            # without the portfolio everything would be privatised
+            raise utils.SPMTFetchError(
+                'Could not fetch the SPMT portfolio - sync aborted')
+        return entries
+
+    def sync(self, force=False, incremental=False, commit_every=None,
+             streaming=None, concurrency=None, snapshot=None):
         """
         Main method to be called to sync content from SPMT
         """
 
         alsoProvides(self.request, IDisableCSRFProtection)
+        registry = getUtility(IRegistry)
+        annotations = IAnnotations(self.context)
+        if snapshot is not None and incremental and not force and \
+                annotations.get(SNAPSHOT_KEY) == snapshot.digest:
+            logger.info('Snapshot %s synced already - nothing to do',
+                        snapshot.digest)
+            self.metrics.count('unchanged_snapshot')
+            return 'UNCHANGED'
+
+        self.configure(incremental=bool(incremental) and not force,
+                       commit_every=commit_every, concurrency=concurrency,
+                       snapshot=snapshot)
+        if streaming is None:
+            streaming = registry.get('pcp.spmtsync.streaming', False)
+        if streaming and utils.ijson is None:
+            logger.warning('Streaming needs the ijson package - '
+                           'parsing the portfolio at once')
+            streaming = False
 
         site = plone.api.portal.get()
         target_folder = self.context
-        spmt_services = utils.getServiceData()
-        email2puid = utils.email2puid(site)
-
-        # collect all subobjects
-        catalog = plone.api.portal.get_tool('portal_catalog')
-        for brain in catalog(path='/'.join(target_folder.getPhysicalPath())):
-            self._objs_original.add(brain.getPath())
+        if streaming and snapshot is None:
+            spmt_services = utils.iterServiceData(
+                session=self._fetcher.session, metrics=self.metrics,
+                timeout=self._fetcher.timeout,
+                retries=self._fetcher.retries)
+        else:
+            streaming = False
+            spmt_services = self.portfolio(snapshot)
+        with self.metrics.phase('contacts'):
+            email2puid = utils.email2puid(site)
+        self._contacts = fetch.ContactResolver(self._fetcher, email2puid)
 
-        if force:
+        if force and self._dry_run:
+            for obj in self.context.contentValues():
+                path = '/'.join(obj.getPhysicalPath())
+                self.changes['delete'].append(path)
+                self._planned_deletions.add(path)
+        elif force:
             logger.debug(
                 'Fresh import - removing all existing entries (force=True)')
             plone.api.content.delete(objects=self.context.contentValues())
+            self.fingerprints().clear()
+            self.uuid_index().clear()
+            IAnnotations(target_folder).pop(CHECKPOINT_KEY, None)
 
-        logger.debug("Iterating over the service data")
+        # collect all subobjects (except those a dry run would delete)
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        for brain in catalog(path='/'.join(target_folder.getPhysicalPath())):
+            path = brain.getPath()
+            if not [deleted for deleted in self._planned_deletions
+                    if path == deleted or path.startswith(deleted + '/')]:
+                self._objs_original.add(path)
 
-        for entry in spmt_services:
-            shortname = entry['name']
-            id = cleanId(shortname)
-            if id == 'test':
-                continue
-            if id is None:
-                logger.warning("Couldn't generate id for ", values)
-                continue
+        logger.debug("Iterating over the service data")
 
-            service = self.check_and_create_object(
-                target_folder, 'Service', id)
+        # streaming keeps the details of pass 2 out of memory
+        details = streaming and utils.SpooledList() or []
+        services = self.iter_services(spmt_services, details)
+        if not streaming:
+            services = list(services)
+            # fetch stage: pull the contacts and the whole service tree
+            # before writing it
+            logger.debug("Prefetching the SPMT service tree")
+            self.prefetch_contacts([entry for id, entry in services])
+            with self.metrics.phase('fetch'):
+                self._fetcher.prefetch_details(
+                    [data for id, data in details])
+            self.collect_listings([entry for id, entry in services])
+        else:
+            services = self.with_contacts(services,
+                                          8 * self._fetcher.concurrency)
 
-            # retrieve data to extended rather than overwrite
-            additional = service.getAdditional()
-            data = self.prepare_data(entry, additional, email2puid, logger)
-            self.update_object(service, data)
+        self.index_services()
+        with self.metrics.phase('services'):
+            self.run_pass(
+                'services', services,
+                lambda id, entry: self.sync_service(id, entry, email2puid),
+                subtree=False)
 
         # second loop so dependencies in 'details' can be resolved
+        # from the index of services built by the first one
 
-        for entry in spmt_services:
-            shortname = entry['name']
-            id = cleanId(shortname)
-            if id == 'test':
-                continue
-            try:
-                service = target_folder[id]
-                data = entry['service_details_list']['service_details'][0]
-                # we assume there is at most one
-                self.addDetails(service, data, logger)
-            except IndexError:
-                pass
+        self.check_dependencies(details)
+        total = len(details)
+        if streaming:
+            details = self.prefetched(details, 8 * self._fetcher.concurrency)
+        with self.metrics.phase('details'):
+            self.run_pass('details', details, self.sync_details, total=total,
+                          digest=self.details_fingerprint)
+        if streaming:
+            details.close()
+
+        self.reindex_dirty()
 
         # compared touch objects against old obj state and
         # make untouched objects (outdated) private
         # RR (2019-05-14): why did we introduce this?
-        untouched_objs = self._objs_original - self._objs_touched
-        for path in untouched_objs:
-            # options are defined in DPMT not SPMT
-            if 'options' in path:
-                continue
-            obj = self.context.restrictedTraverse(path)
-            if obj != target_folder:
-                state = plone.api.content.get_state(obj=obj)
-                if state != 'private':
-                    plone.api.content.transition(obj=obj, to_state='private')
+        with self.metrics.phase('privatise'):
+            self.privatise_untouched()
+
+        summary = json.dumps(self.metrics.summary())
+        logger.info('Sync summary: %s', summary)
+        if not self._dry_run:
+            annotations.pop(CHECKPOINT_KEY, None)
+            annotations[METRICS_KEY] = summary
+            counters = self.metrics.counters
+            if snapshot is not None and not counters.get('failed') and \
+                    not counters.get('failed_fetches'):
+                annotations[SNAPSHOT_KEY] = snapshot.digest
+            else:
+                annotations.pop(SNAPSHOT_KEY, None)
 
         return 'DONE'
+
+    def sync_services(self, uuids, incremental=False, concurrency=None,
+                      snapshot=None, partition=False):
+        """Sync only the services with the SPMT `uuids` (a list or a comma
+        separated string) and return the ids synced and the unknown uuids
+        as JSON; `partition` marks a worker of a partitioned sync"""
+        alsoProvides(self.request, IDisableCSRFProtection)
+        if not isinstance(uuids, (list, tuple)):
+            uuids = uuids.split(',')
+        wanted = set(uuid.strip() for uuid in uuids if uuid.strip())
+        self.configure(incremental=incremental, commit_every=0,
+                       concurrency=concurrency, snapshot=snapshot)
+        entries = [entry for entry in self.portfolio(snapshot)
+                   if entry['uuid'] in wanted]
+        unknown = sorted(wanted - set(entry['uuid'] for entry in entries))
+        if unknown:
+            logger.warning('Unknown SPMT services: %s', ', '.join(unknown))
+        with self.metrics.phase('contacts'):
+            email2puid = utils.email2puid(plone.api.portal.get())
+        self._contacts = fetch.ContactResolver(self._fetcher, email2puid)
+
+        details = []
+        services = list(self.iter_services(entries, details))
+        base = '/'.join(self.context.getPhysicalPath())
+        paths = [base + '/' + id for id, entry in services]
+        if paths:
+            # also in a partition: touching a skipped subtree needs them
+            self.collect_original(paths)
+        if partition:
+            # the trees are shared by all workers - leave them to the
+            # coordinator to avoid conflicts
+            self._pending = {'fingerprints': PendingMapping(
+                                 self.fingerprints()),
+                             'uuids': PendingMapping(self.uuid_index())}
+
+        self.prefetch_contacts(entries)
+        with self.metrics.phase('fetch'):
+            self._fetcher.prefetch_details(
+                [data for id, data in details])
+        self.index_services()
+        with self.metrics.phase('services'):
+            self.run_pass(
+                'services', services,
+                lambda id, entry: self.sync_service(id, entry, email2puid),
+                subtree=False)
+        self.check_dependencies(details)
+        with self.metrics.phase('details'):
+            self.run_pass('details', details, self.sync_details,
+                          digest=self.details_fingerprint)
+        self.reindex_dirty()
+        result = {'synced': [id for id, entry in services],
+                  'unknown': unknown}
+        if partition:
+            result.update(self.partition_result())
+        else:
+            with self.metrics.phase('privatise'):
+                self.privatise_untouched(paths)
+
+        summary = json.dumps(self.metrics.summary())
+        logger.info('Sync summary (%s): %s', ', '.join(sorted(wanted)),
+                    summary)
+        if not partition:
+            # the workers of a partitioned sync would conflict here
+            IAnnotations(self.context)[METRICS_KEY] = summary
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(result)
+
+    def touched(self):
+        """Return the paths of the objects touched by this sync so far"""
+        return sorted(self._objs_touched)
+
+    def partition_result(self):
+        """Return what the coordinator of a partitioned sync needs from a
+        worker: the paths touched and the new fingerprints and uuids"""
+        return {'touched': self.touched(),
+                'fingerprints': self._pending['fingerprints'].changes,
+                'uuids': self._pending['uuids'].changes}
+
+    def collect_original(self, paths):
+        """Remember the objects below `paths` that exist before the sync"""
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        for brain in catalog.unrestrictedSearchResults(path=paths):
+            self._objs_original.add(brain.getPath())
+
+    def create_services(self, snapshot, incremental=False):
+        """First step of a partitioned sync: create the missing Services of
+        the `snapshot` and return the SPMT uuids to be synced"""
+        self.configure(incremental=incremental, commit_every=0,
+                       snapshot=snapshot)
+        self.collect_original('/'.join(self.context.getPhysicalPath()))
+        # created here, so that the workers do not race for them
+        self.fingerprints()
+        self.uuid_index()
+        uuids = []
+        for id, entry in self.iter_services(snapshot.services(), []):
+            self.check_and_create_object(self.context, 'Service', id,
+                                         entry['uuid'])
+            uuids.append(entry['uuid'])
+        return uuids
+
+    def finish_partitions(self, snapshot, touched, fingerprints=None,
+                          uuids=None):
+        """Last step of a partitioned sync: store the workers' entries, link
+        the dependencies and privatise what no worker `touched`"""
+        for uuid, fingerprint in (fingerprints or {}).items():
+            self.record_fingerprint(fingerprint, uuid)
+        index = self.uuid_index()
+        for uuid, relative in (uuids or {}).items():
+            if index.get(uuid) != relative:
+                index[uuid] = relative
+        self._objs_touched.update(touched)
+        details = []
+        for id, entry in self.iter_services(snapshot.services(), details):
+            self._objs_touched.add(
+                '/'.join(self.context.getPhysicalPath()) + '/' + id)
+        self.index_services()
+        self.check_dependencies(details)
+        with self.metrics.phase('dependencies'):
+            for id, data in details:
+                service = self.context._getOb(id, None)
+                obj = None if service is None \
+                    else service._getOb('details', None)
+                if obj is not None:
+                    self.update_object(obj, self.details_fields(data))
+        self.reindex_dirty()
+        with self.metrics.phase('privatise'):
+            self.privatise_untouched()
+        summary = json.dumps(self.metrics.summary())
+        logger.info('Sync summary (partitioned): %s', summary)
+        IAnnotations(self.context)[METRICS_KEY] = summary
+
+    def sync_in_background(self, force=False, incremental=False,
+                           commit_every=None, streaming=None):
+        """Queue a `sync` with the given options as a background job of
+        this Zope process and return its id and progress URL as JSON"""
+        options = {'force': force,
+                   'incremental': incremental,
+                   'commit_every': commit_every,
+                   'streaming': streaming}
+        job_id = jobs.startSyncJob(self.context, options)
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps({
+            'job': job_id,
+            'progress': '{}/@@sync-progress?job={}'.format(
+                self.context.absolute_url(), job_id)})
+
+    def job_progress(self, job=None):
+        """Return the status of the background sync job `job` as JSON:
+        its state, the current pass and phase, the number of services
+        done and in total, counters and errors"""
+        self.request.response.setHeader('Content-Type', 'application/json')
+        status = jobs.jobStatus(job)
+        if status is None:
+            self.request.response.setStatus(404)
+            return json.dumps({'error': "Unknown job '%s'" % job})
+        return json.dumps(status, default=repr)
+
+    def last_metrics(self):
+        """Return the metrics of the last sync of this folder as JSON"""
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return IAnnotations(self.context).get(METRICS_KEY, '{}')
+
+    def privatise_untouched(self, paths=None):
+        """Make the objects below the target folder (or `paths`) that the
+        sync did not touch private and return their number"""
+        base = '/'.join(self.context.getPhysicalPath())
+        if paths is not None and not paths:
+            return 0
+        excluded = set(config.dpmt_only_ids)
+        catalog = plone.api.portal.get_tool('portal_catalog')
+        brains = []
+        for brain in catalog.unrestrictedSearchResults(
+                path=base if paths is None else list(paths)):
+            path = brain.getPath()
+            if path == base or path in self._objs_touched \
+                    or path not in self._objs_original:
+                continue
+            if excluded.intersection(path[len(base) + 1:].split('/')):
+                continue
+            if brain.review_state == 'private':
+                continue
+            brains.append(brain)
+
+        if self._dry_run:
+            self.changes['privatise'].extend(
+                brain.getPath() for brain in brains)
+            return 0
+
+        for brain in brains:
+            obj = brain._unrestrictedGetObject()
+            plone.api.content.transition(obj=obj, to_state='private')
+        if processQueue is not None:
+            # reindex all the transitioned objects in one go
+            processQueue()
+        self.metrics.count('privatised', len(brains))
+        logger.info('Made {} outdated objects private'.format(len(brains)))
+        return len(brains)
+
+    def plan(self, force=False, incremental=False, streaming=None,
+             concurrency=None, snapshot=None):
+        """Dry run of `sync`: return the changes a sync would make as JSON
+        without writing anything"""
+        transaction.doom()
+        self._dry_run = True
+        self.sync(force=force, incremental=incremental, commit_every=0,
+                  streaming=streaming, concurrency=concurrency,
+                  snapshot=snapshot)
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.changes, default=repr, indent=2)
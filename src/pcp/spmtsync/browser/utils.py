@@ -1,74 +1,354 @@
+import hashlib
 import logging
 import requests
 import json
+import tempfile
+import time
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from BTrees.Length import Length
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility
+from zope.component.hooks import getSite
 from plone.registry. interfaces import IRegistry
+from Products.CMFCore.utils import getToolByName
+
+from pcp.spmtsync.browser import config
+from pcp.spmtsync.browser import log
+
+
+logger = logging.getLogger('spmtsync')
+
+# site path -> (people version, mapping email -> UID) (see email2puid)
+_email2puid_cache = {}
+
+# annotation on the people folder: number of changes to Persons, which
+# tells the ZEO clients that their cached mappings are outdated
+PEOPLE_VERSION_KEY = 'pcp.spmtsync.people_version'
+
+# responses and errors of SPMT that are worth retrying (see requestSPMT)
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
 
 
 def getLogger(logfilename='var/log/spmtsync.log'):
-    logger = logging.getLogger('spmtsync')
-    logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler(logfilename)
-    fh.setLevel(logging.DEBUG)
-    # create console handler with a higher log level
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.WARNING)
-    # create formatter and add it to the handlers
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    console_formatter = logging.Formatter(
-        '%(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(file_formatter)
-    ch.setFormatter(console_formatter)
-    # add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
-
-    return logger
-
-
-def getDataFromSPMT(url):
-    """Returns the payload from url or None.
-    Never fails."""
-    if 'localhost' in url:
-        registry = getUtility(IRegistry)
-        SPMT_BASE = registry['pcp.spmtsync.baseurl']
+    """Return the 'spmtsync' logger logging everything to `logfilename`
+    (see log.configureLogging)"""
+    return log.configureLogging(logfilename, level='DEBUG')
+
+
+class SPMTFetchError(Exception):
+    """A SPMT document could not be retrieved"""
+
+
+def requestSPMT(url, session=None, cache=None, metrics=None, timeout=None,
+                retries=0, backoff=0.5):
+    """Return the JSON body of the response from url.
+    Uses the pooled `session` (a requests.Session) if given.
+    With a `cache` (see httpcache.ResponseCache) the request is made
+    conditional and a 304 response is answered from the cache.
+    Every attempt is bounded by `timeout` seconds; connection errors,
+    timeouts and the TRANSIENT_STATUS responses are retried up to
+    `retries` times after waiting `backoff`, 2 * `backoff`, ... seconds.
+    The responses are recorded in `metrics` (see metrics.SyncMetrics).
+    Raises SPMTFetchError if no successful response was received."""
+    entry = None
+    headers = {}
+    if cache is not None:
+        entry = cache.lookup(url)
+        headers = cache.conditional_headers(entry)
+    result = _retrying(url, session=session, headers=headers,
+                       metrics=metrics, timeout=timeout, retries=retries,
+                       backoff=backoff)
+    if result.status_code == 304 and entry is not None:
+        return entry['body']
+    if not result.ok:
+        raise SPMTFetchError('HTTP {}'.format(result.status_code))
+    try:
+        body = result.json()
+    except ValueError:
+        raise SPMTFetchError('Invalid JSON')
+    if cache is not None:
+        cache.store(url, result, body)
+    return body
 
-    result = requests.get(url)
-    if result.ok:
+
+def _retrying(url, session=None, headers=None, metrics=None, timeout=None,
+              retries=0, backoff=0.5, stream=False):
+    """Return the first response from url that is not one of the
+    TRANSIENT_STATUS (see requestSPMT for the retries). Responses to
+    `stream` requests are not recorded in `metrics`."""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+            if metrics is not None:
+                metrics.count('retries')
+        started = time.time()
         try:
-            return result.json()['data']
-        except KeyError:
-            # TODO add logging
-            return None
+            result = (session or requests).get(url, headers=headers or {},
+                                               timeout=timeout, stream=stream)
+        except TRANSIENT_ERRORS as exc:
+            reason = exc.__class__.__name__
+            continue
+        except requests.RequestException as exc:
+            raise SPMTFetchError(exc.__class__.__name__)
+        if metrics is not None and not stream:
+            metrics.record_fetch(url, time.time() - started,
+                                 len(result.content), result.status_code)
+        if result.status_code not in TRANSIENT_STATUS:
+            return result
+        reason = 'HTTP {}'.format(result.status_code)
+        if stream:
+            result.close()
+    raise SPMTFetchError('{} after {} attempts'.format(reason, retries + 1))
+
+
+def payload(body):
+    """Return the 'data' of a SPMT response body or None"""
+    try:
+        return body['data']
+    except (KeyError, TypeError):
+        return None
+
+
+def getDataFromSPMT(url, session=None, cache=None, metrics=None,
+                    timeout=None, retries=0):
+    """Returns the payload from url or None (see requestSPMT for the
+    arguments). Failures are logged and recorded in `metrics`.
+    Never fails."""
+    try:
+        body = requestSPMT(url, session=session, cache=cache,
+                           metrics=metrics, timeout=timeout, retries=retries)
+    except SPMTFetchError as exc:
+        logger.warning("Fetching '{}' failed: {}".format(url, exc))
+        if metrics is not None:
+            metrics.record_failure(url, str(exc))
+        return None
+    return payload(body)
+
+
+def fingerprint(data):
+    """Return a digest of the JSON serializable `data` that does not
+    depend on the order of the keys"""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'),
+                           default=repr)
+    if not isinstance(canonical, bytes):
+        canonical = canonical.encode('utf8')
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def findCycles(graph):
+    """Return the cycles of the directed `graph` (a mapping node -> list
+    of nodes), each as a list of nodes starting and ending with the same
+    node"""
+    cycles = []
+    visiting = []
+    visited = set()
+
+    def visit(node):
+        visiting.append(node)
+        for successor in graph.get(node, ()):
+            if successor in visiting:
+                cycles.append(visiting[visiting.index(successor):] + [successor])
+            elif successor not in visited:
+                visit(successor)
+        visiting.pop()
+        visited.add(node)
 
+    for node in sorted(graph):
+        if node not in visited:
+            visit(node)
+    return cycles
 
-def getServiceData():
+
+def checkDependencies(details, node, known):
+    """Return the dangling dependencies and the dependency cycles among the
+    service `details` (a list of (service id, details data) pairs), where
+    `node(dep)` is the service id the dependency `dep` refers to and
+    `known(dep)` tells whether that Service exists"""
+    graph = {}
+    dangling = {}
+    for id, data in details:
+        deps = data['dependencies_list']['services'] or []
+        graph[id] = [node(dep) for dep in deps]
+        missing = [dep['service']['name'] for dep in deps if not known(dep)]
+        if missing:
+            dangling[id] = missing
+            logger.warning("'%s' depends on unknown services: %s"
+                           % (id, ', '.join(missing)))
+    cycles = findCycles(graph)
+    for cycle in cycles:
+        logger.warning('Dependency cycle: %s' % ' -> '.join(cycle))
+    return {'dangling': dangling, 'cycles': cycles}
+
+
+def chunked(items, size):
+    """Yield the `items` in lists of up to `size` items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class SpooledList(object):
+    """Append-only list of JSON serializable items kept in a temporary
+    file, which is read back one item at a time when iterating"""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile(mode='w+')
+        self._count = 0
+
+    def append(self, item):
+        self._file.seek(0, 2)
+        self._file.write(json.dumps(item) + '\n')
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        position = 0
+        while True:
+            self._file.seek(position)
+            line = self._file.readline()
+            if not line:
+                return
+            position = self._file.tell()
+            yield json.loads(line)
+
+    def close(self):
+        self._file.close()
+
+
+def getServiceData(session=None, cache=None, metrics=None, timeout=None,
+                   retries=0):
     """return a list of dictionaries with the service data"""
     registry = getUtility(IRegistry)
     source_url = registry['pcp.spmtsync.portfoliourl']
-    source = getDataFromSPMT(source_url)
+    source = getDataFromSPMT(source_url, session=session, cache=cache,
+                             metrics=metrics, timeout=timeout,
+                             retries=retries)
     if source:
         return source['services']
     return None
 
 
+def iterServiceData(session=None, metrics=None, timeout=None, retries=0):
+    """Iterate over the service data (see `getServiceData`) while it is
+    being downloaded, parsing one service at a time, so that the whole
+    portfolio is never held in memory. Needs the optional `ijson` package
+    and bypasses the response cache. Raises SPMTFetchError on
+    unsuccessful responses and, at the end, if there were no services."""
+    registry = getUtility(IRegistry)
+    source_url = registry['pcp.spmtsync.portfoliourl']
+    started = time.time()
+    result = _retrying(source_url, session=session, metrics=metrics,
+                       timeout=timeout, retries=retries, stream=True)
+    if not result.ok:
+        result.close()
+        raise SPMTFetchError('HTTP {}'.format(result.status_code))
+    result.raw.decode_content = True
+    count = 0
+    try:
+        for entry in ijson.items(result.raw, 'data.services.item',
+                                 use_float=True):
+            count += 1
+            yield entry
+    finally:
+        if metrics is not None:
+            metrics.record_fetch(source_url, time.time() - started,
+                                 result.raw.tell(), result.status_code)
+        result.close()
+    if not count:
+        # without services everything would be privatised
+        raise SPMTFetchError(
+            'No services in the SPMT portfolio at {}'.format(source_url))
+
+
 def email2puid(site):
     """
     Return a mapping email -> UID for all exisitng Person objects.
     If an email address occurs several times only the first hit is
     recorded and a warning is logged.
+    The exceptions in config.creg2dp_email are already applied, so
+    looking up the lower-cased email is all that is needed.
+    The mapping is cached until a Person is added, modified or removed
+    in any process (see invalidateEmail2puid) and must not be modified.
     """
+    key = '/'.join(site.getPhysicalPath())
+    version = _peopleVersion(site.people)
+    cached = _email2puid_cache.get(key, None)
+    if cached is None or cached[0] != version:
+        cached = _email2puid_cache[key] = (version, _buildEmail2puid(site))
+    return cached[1]
+
+
+def _peopleVersion(people):
+    counter = IAnnotations(people).get(PEOPLE_VERSION_KEY, None)
+    return counter() if counter is not None else 0
+
+
+def _buildEmail2puid(site):
+    """Build the mapping for email2puid from the catalog. The emails are
+    taken from the 'getEmail' metadata column if available so that the
+    Person objects need not be loaded (except those cataloged before
+    the column was added)."""
     logger = logging.getLogger('contacts')
-    result = {}
-    for person in site.people.contentValues():
-        email = person.getEmail().lower()
-        uid = person.UID()
-        if email and email in result.keys():
+    catalog = getToolByName(site, 'portal_catalog')
+    has_email = 'getEmail' in catalog.schema()
+    people = '/'.join(site.people.getPhysicalPath())
+    persons = {}
+    for brain in catalog.unrestrictedSearchResults(
+            path={'query': people, 'depth': 1}):
+        email = brain.getEmail if has_email else None
+        if not isinstance(email, (str, type(u''))):
+            # no column or Missing.Value: not reindexed since
+            email = brain._unrestrictedGetObject().getEmail()
+        email = (email or '').lower()
+        uid = brain.UID
+        if email and email in persons:
             logger.warning("'%s' already found - skipping" % email)
             continue
-        logger.debug("Mapping '%s' to '%s'" % (email, uid))
-        result[email] = uid
-    return result.copy()
+        logger.debug("Mapping '%s' to '%s'", email, uid)
+        persons[email] = uid
+
+    result = persons.copy()
+    # map exceptions: an SPMT email maps to the person registered
+    # under the corresponding DPMT email and vice versa
+    for creg_email, dp_email in config.creg2dp_email.items():
+        creg_email, dp_email = creg_email.lower(), dp_email.lower()
+        if dp_email in persons:
+            result[creg_email] = persons[dp_email]
+    for creg_email, dp_email in config.creg2dp_email.items():
+        creg_email, dp_email = creg_email.lower(), dp_email.lower()
+        if dp_email not in result and creg_email in persons:
+            result[dp_email] = persons[creg_email]
+    return result
+
+
+def invalidateEmail2puid(obj, event):
+    """Event subscriber dropping the cached email2puid mappings whenever
+    a Person is added, modified or removed - in this process right away,
+    in the other ZEO clients through the people version they check"""
+    if getattr(obj, 'portal_type', None) != 'Person':
+        return
+    _email2puid_cache.clear()
+    site = getSite()
+    people = site._getOb('people', None) if site is not None else None
+    if people is None:
+        return
+    annotations = IAnnotations(people)
+    if PEOPLE_VERSION_KEY not in annotations:
+        annotations[PEOPLE_VERSION_KEY] = Length()
+    # a Length resolves concurrent changes instead of conflicting
+    annotations[PEOPLE_VERSION_KEY].change(1)
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Run the SPMT sync outside of a web request, e.g. from cron.
+
+Either through the Zope instance script, which provides the `app`::
+
+  bin/instance run src/pcp/spmtsync/console.py /Plone/services --incremental
+
+or with the `spmtsync` console script and the instance's zope.conf::
+
+  bin/spmtsync --zope-conf parts/instance/etc/zope.conf /Plone/services
+
+With --export the SPMT data is written to a snapshot file instead of
+being synced, --snapshot syncs from such a file and --diff compares two
+snapshot files (no Zope needed)::
+
+  bin/instance run src/pcp/spmtsync/console.py --export spmt.jsonl.gz /Plone
+  bin/spmtsync --diff yesterday.jsonl.gz spmt.jsonl.gz
+
+Given several folders, the SPMT data is fetched once and the folders are
+synced from it in parallel by worker processes (see
+pcp.spmtsync.coordinator), which needs a ZEO setup::
+
+  bin/spmtsync --zope-conf parts/client1/etc/zope.conf --incremental \
+      /Plone/services /Other/services
+
+With --partitions the services of a single folder are split into that
+many parts, each written by its own worker process, and the dependencies
+are linked once all of them committed (see jobs.runPartitionedSync)::
+
+  bin/spmtsync --zope-conf parts/client1/etc/zope.conf --partitions 4 \
+      /Plone/services
+
+Exit status: 0 on success, 1 if the sync failed, 2 on wrong usage,
+3 if the sync finished but some services or SPMT documents could not be
+synced and 4 if the snapshots compared with --diff differ.
+"""
+import argparse
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import traceback
+
+from zope.component.hooks import setSite
+
+from pcp.spmtsync import coordinator
+from pcp.spmtsync.browser import jobs
+from pcp.spmtsync.browser import snapshots
+from pcp.spmtsync.browser.metrics import SyncMetrics
+
+
+logger = logging.getLogger('spmtsync')
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_PARTIAL = 3
+EXIT_CHANGED = 4
+
+
+def parser():
+    parser = argparse.ArgumentParser(
+        prog='spmtsync',
+        description='Sync portfolio folders with SPMT')
+    parser.add_argument(
+        'folders', nargs='*', metavar='folder',
+        help='path of a folder providing IPortfolioRoot, '
+             'e.g. /Plone/services')
+    parser.add_argument(
+        '--site', default=None,
+        help='path of the Plone site (default: first element of folder)')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of folders synced at the same time '
+             '(default: all of them)')
+    parser.add_argument(
+        '--partitions', type=int, default=None,
+        help='split the services of the folder into N parts synced by '
+             'one worker each')
+    parser.add_argument(
+        '--partition', action='store_true',
+        help=argparse.SUPPRESS)  # set on the workers of --partitions
+    parser.add_argument(
+        '--worker-command', default=None,
+        help='command starting a worker syncing one folder, e.g. '
+             '"bin/instance run src/pcp/spmtsync/console.py" '
+             '(default: this script)')
+    parser.add_argument(
+        '--user', default='admin',
+        help='id of the user the sync runs as (default: admin)')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='remove all existing entries before the import')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='skip subtrees whose SPMT payload did not change')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='print the changes a sync would make as JSON, write nothing')
+    parser.add_argument(
+        '--concurrency', type=int, default=None,
+        help='number of concurrent requests to SPMT '
+             '(default: pcp.spmtsync.concurrency)')
+    parser.add_argument(
+        '--commit-every', type=int, default=None,
+        help='commit after every N services, 0 for a single transaction '
+             '(default: pcp.spmtsync.commit_every)')
+    parser.add_argument(
+        '--streaming', action='store_true', default=None,
+        help='parse the portfolio while it is downloaded')
+    parser.add_argument(
+        '--services', metavar='UUIDS', default=None,
+        help='sync only the services with these comma separated SPMT uuids')
+    parser.add_argument(
+        '--snapshot', metavar='FILE', default=None,
+        help='read the SPMT data from a snapshot file instead of SPMT')
+    parser.add_argument(
+        '--export', metavar='FILE', default=None,
+        help='write the SPMT data to a snapshot file instead of syncing')
+    parser.add_argument(
+        '--diff', metavar=('OLD', 'NEW'), nargs=2, default=None,
+        help='print the differences between two snapshot files')
+    parser.add_argument(
+        '--zope-conf', default=None,
+        help='zope.conf of the instance; not needed with "bin/instance run"')
+    return parser
+
+
+def zope_app(zope_conf):
+    """Configure Zope from `zope_conf` and return the root application"""
+    import Zope2
+    try:
+        Zope2.configure(zope_conf)
+    except AttributeError:  # Zope 4 and later
+        from Zope2.Startup.run import configure_wsgi
+        configure_wsgi(zope_conf)
+    return Zope2.app()
+
+
+def main(argv=None, app=None):
+    """Run a sync as described by the command line `argv` on the Zope
+    application `app` (opened from --zope-conf if not given) and return
+    the exit status"""
+    arguments = parser()
+    try:
+        args = arguments.parse_args(argv)
+        if args.diff is None and not args.folders:
+            arguments.error('the folder is required')
+        if args.services and (args.dry_run or args.force or args.streaming):
+            arguments.error('--services cannot be combined with --dry-run, '
+                            '--force or --streaming')
+        if len(args.folders) > 1 and (args.dry_run or args.services or
+                                      args.export or args.streaming):
+            arguments.error('several folders cannot be combined with '
+                            '--dry-run, --services, --export or --streaming')
+        if args.partitions is not None and (
+                len(args.folders) != 1 or args.partitions < 1 or
+                args.dry_run or args.force or args.services or
+                args.export or args.streaming):
+            arguments.error('--partitions needs a single folder and a '
+                            'positive number and cannot be combined with '
+                            '--dry-run, --force, --services, --export or '
+                            '--streaming')
+        if args.partition and not args.services:
+            arguments.error('--partition needs --services')
+    except SystemExit as exc:
+        return exc.code and EXIT_USAGE
+    if args.diff is not None:
+        return diff(*args.diff)
+    folders = ['/' + folder.strip('/') for folder in args.folders]
+    if len(folders) > 1:
+        return fan_out(args, folders, app)
+    folder = folders[0]
+    if args.partitions is not None:
+        return partitioned(args, folder, app)
+    site = args.site or site_of(folder)
+    options = {
+        'force': args.force,
+        'incremental': args.incremental,
+        'streaming': args.streaming,
+        'concurrency': args.concurrency,
+    }
+    if args.dry_run:
+        options['dry_run'] = True
+    elif args.services:
+        options = {'services': args.services.split(','),
+                   'incremental': args.incremental,
+                   'concurrency': args.concurrency,
+                   'partition': args.partition}
+    else:
+        options['commit_every'] = args.commit_every
+    if app is None:
+        if not args.zope_conf:
+            sys.stderr.write('spmtsync: --zope-conf is required unless '
+                             'run through "bin/instance run"\n')
+            return EXIT_USAGE
+        app = zope_app(args.zope_conf)
+    if args.export:
+        return export(app, site, args.export, concurrency=args.concurrency)
+    if args.snapshot:
+        options['snapshot'] = snapshots.Snapshot.load(args.snapshot)
+    try:
+        view = jobs.runSync(app, site, folder, args.user, options)
+    except Exception:
+        traceback.print_exc()
+        logger.exception('Sync of {} failed'.format(folder))
+        return EXIT_ERROR
+    if args.dry_run:
+        print(json.dumps(view.changes, default=repr, indent=2))
+    elif args.partition:
+        # read by the coordinator of the partitioned sync
+        output = view.partition_result()
+        output['summary'] = view.metrics.summary()
+        print(json.dumps(output))
+    else:
+        print(json.dumps(view.metrics.summary(), indent=2))
+    counters = view.metrics.counters
+    if counters.get('failed', 0) or counters.get('failed_fetches', 0):
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def site_of(folder):
+    """Return the path of the Plone site of the `folder` path"""
+    return '/' + folder.split('/')[1]
+
+
+def worker_command(args):
+    """Return the command starting a worker process as list or None if
+    it cannot be told"""
+    if args.worker_command:
+        return shlex.split(args.worker_command)
+    if not sys.argv[0].endswith('.py'):
+        return [sys.argv[0]]
+    sys.stderr.write('spmtsync: --worker-command is required when run '
+                     'through "bin/instance run"\n')
+    return None
+
+
+def fan_out(args, folders, app=None):
+    """Sync the `folders` from a single download of the SPMT data (or
+    from the --snapshot given) in parallel worker processes"""
+    command = worker_command(args)
+    if command is None:
+        return EXIT_USAGE
+    directory = None
+    path = args.snapshot
+    if path is None:
+        opened = app is None
+        if opened:
+            if not args.zope_conf:
+                sys.stderr.write('spmtsync: --zope-conf is required unless '
+                                 'run through "bin/instance run"\n')
+                return EXIT_USAGE
+            app = zope_app(args.zope_conf)
+        directory = tempfile.mkdtemp(prefix='spmtsync-')
+        path = os.path.join(directory, 'spmt.jsonl.gz')
+        try:
+            write_snapshot(app, args.site or site_of(folders[0]), path,
+                          concurrency=args.concurrency)
+        except Exception:
+            traceback.print_exc()
+            logger.exception('Fetching the SPMT data failed')
+            shutil.rmtree(directory)
+            return EXIT_ERROR
+        finally:
+            if opened:
+                # release the storage for the workers
+                app._p_jar.db().close()
+    try:
+        results = coordinator.fanOut(
+            command, folders, path, workers=args.workers,
+            zope_conf=args.zope_conf, user=args.user,
+            incremental=args.incremental, force=args.force,
+            commit_every=args.commit_every)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    print(json.dumps(results, indent=2))
+    failed = [result for result in results.values() if result['status']]
+    if not failed:
+        return EXIT_OK
+    if len(failed) == len(results):
+        return EXIT_ERROR
+    return EXIT_PARTIAL
+
+
+def partitioned(args, folder, app=None):
+    """Sync the services of `folder` from a single download of the SPMT
+    data (or from the --snapshot given) in --partitions worker processes
+    (see jobs.runPartitionedSync)"""
+    command = worker_command(args)
+    if command is None:
+        return EXIT_USAGE
+    if app is None:
+        if not args.zope_conf:
+            sys.stderr.write('spmtsync: --zope-conf is required unless '
+                             'run through "bin/instance run"\n')
+            return EXIT_USAGE
+        app = zope_app(args.zope_conf)
+    site = args.site or site_of(folder)
+    directory = None
+    path = args.snapshot
+    try:
+        if path is None:
+            directory = tempfile.mkdtemp(prefix='spmtsync-')
+            path = os.path.join(directory, 'spmt.jsonl.gz')
+            write_snapshot(app, site, path, concurrency=args.concurrency)
+        view, results = jobs.runPartitionedSync(
+            app, site, folder, args.user, path, command, args.partitions,
+            workers=args.workers,
+            options={'zope_conf': args.zope_conf, 'user': args.user,
+                     'incremental': args.incremental})
+    except Exception:
+        traceback.print_exc()
+        logger.exception('Partitioned sync of {} failed'.format(folder))
+        return EXIT_ERROR
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    print(json.dumps({'partitions': results,
+                      'summary': view.metrics.summary()}, indent=2))
+    failed = [result for result in results if result['status']]
+    if not failed:
+        return EXIT_OK
+    if len(failed) == len(results):
+        return EXIT_ERROR
+    return EXIT_PARTIAL
+
+
+def diff(old, new):
+    """Print the differences between the snapshot files `old` and `new`"""
+    try:
+        changes = snapshots.diffSnapshots(old, new)
+    except (IOError, OSError, ValueError) as exc:
+        sys.stderr.write('spmtsync: {}\n'.format(exc))
+        return EXIT_ERROR
+    print(json.dumps(changes, indent=2))
+    if [urls for urls in changes.values() if urls]:
+        return EXIT_CHANGED
+    return EXIT_OK
+
+
+def export(app, site_path, path, concurrency=None):
+    """Write a snapshot of the SPMT data configured for the Plone site at
+    `site_path` to the file `path`"""
+    try:
+        snapshot = write_snapshot(app, site_path, path,
+                                 concurrency=concurrency)
+    except Exception:
+        traceback.print_exc()
+        logger.exception('Export of a snapshot to {} failed'.format(path))
+        return EXIT_ERROR
+    print(json.dumps(snapshot.header(), indent=2))
+    if snapshot.failed:
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def write_snapshot(app, site_path, path, concurrency=None):
+    """Write a snapshot of the SPMT data configured for the Plone site at
+    `site_path` to the file `path` and return it"""
+    setSite(app.unrestrictedTraverse(site_path))
+    try:
+        snapshot = snapshots.exportFromRegistry(concurrency=concurrency,
+                                                metrics=SyncMetrics())
+        snapshot.save(path)
+    finally:
+        setSite(None)
+    return snapshot
+
+
+if __name__ == '__main__':
+    # "bin/instance run" passes the application as global `app`
+    sys.exit(main(sys.argv[1:], app=globals().get('app')))
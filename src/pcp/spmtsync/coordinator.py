@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Run syncs from one SPMT snapshot in parallel worker processes.
+
+The SPMT data is fetched once into a snapshot file (see
+pcp.spmtsync.browser.snapshots). Then either each of several target
+folders is synced from that file by a separate worker process (`fanOut`)
+or the services of one folder are split into partitions synced by one
+worker each (`runPartitions`, see jobs.runPartitionedSync). The workers
+run the console script (see pcp.spmtsync.console) and open the database
+themselves, so the storage has to allow several processes - i.e. a ZEO
+setup.
+"""
+import json
+import logging
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger('spmtsync')
+
+
+def workerArguments(command, folder, snapshot, zope_conf=None, user=None,
+                    incremental=False, force=False, commit_every=None,
+                    services=None):
+    """Return the command line of a worker syncing `folder` - or only
+    the partition of its `services` (SPMT uuids) - from the snapshot
+    file `snapshot`"""
+    args = list(command)
+    if zope_conf:
+        args += ['--zope-conf', zope_conf]
+    if user:
+        args += ['--user', user]
+    if incremental:
+        args.append('--incremental')
+    if force:
+        args.append('--force')
+    if commit_every is not None:
+        args += ['--commit-every', str(commit_every)]
+    if services is not None:
+        args += ['--partition', '--services', ','.join(services)]
+    args += ['--snapshot', snapshot, folder]
+    return args
+
+
+def runWorker(args):
+    """Run the worker command line `args` and return its exit status and
+    its output (the metrics summary as printed by the console script)"""
+    logger.info('Starting sync worker: %s', ' '.join(args))
+    worker = subprocess.Popen(args, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    out, err = worker.communicate()
+    result = {'status': worker.returncode}
+    try:
+        result['summary'] = json.loads(out.decode('utf8'))
+    except ValueError:
+        result['output'] = out.decode('utf8', 'replace')[-2000:]
+    if worker.returncode:
+        result['errors'] = err.decode('utf8', 'replace')[-2000:]
+    return result
+
+
+def runWorkers(arguments, workers=None):
+    """Run the worker command lines `arguments`, at most `workers` at a
+    time, and return their results (see runWorker) in the same order"""
+    if not arguments:
+        return []
+    workers = max(1, min(workers or len(arguments), len(arguments)))
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(runWorker, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fanOut(command, folders, snapshot, workers=None, **options):
+    """Sync each of the `folders` from the snapshot file `snapshot` in a
+    worker process started with `command` (a list, see workerArguments
+    for the `options`), at most `workers` at a time. Return the mapping
+    folder -> result (see runWorker)."""
+    folders = list(folders)
+    results = runWorkers([
+        workerArguments(command, folder, snapshot, **options)
+        for folder in folders], workers)
+    for folder, result in zip(folders, results):
+        if result['status']:
+            logger.warning('Sync of %s failed with status %s', folder,
+                           result['status'])
+    return dict(zip(folders, results))
+
+
+def runPartitions(command, folder, snapshot, partitions, workers=None,
+                  **options):
+    """Sync the `partitions` (lists of SPMT uuids) of the services of
+    `folder` from the snapshot file `snapshot` in one worker process
+    each (see fanOut) and return their results in the same order"""
+    results = runWorkers([
+        workerArguments(command, folder, snapshot, services=partition,
+                        **options)
+        for partition in partitions], workers)
+    for number, result in enumerate(results, 1):
+        if result['status']:
+            logger.warning('Partition %d of %s failed with status %s',
+                           number, folder, result['status'])
+    return results
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Plone layer and base class of the tests syncing synthetic portfolios
+(see ``spmtstub.py``); they need the layer support of ``zope-testrunner``::
+
+  zope-testrunner --test-path=tests --tests-pattern='^test_incremental$'
+"""
+import os
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+import plone.api
+import transaction
+
+from plone.app.testing import FunctionalTesting
+from plone.app.testing import PLONE_FIXTURE
+from plone.app.testing import PloneSandboxLayer
+from plone.app.testing import SITE_OWNER_NAME
+from plone.app.testing import applyProfile
+from plone.app.testing import login
+from plone.registry.interfaces import IRegistry
+from plone.testing import z2
+from zope.component import getUtility
+from zope.interface import alsoProvides
+
+from pcp.spmtsync.interfaces import IPortfolioRoot
+
+from spmtstub import SPMTStub
+
+
+class SPMTSyncLayer(PloneSandboxLayer):
+
+    defaultBases = (PLONE_FIXTURE,)
+
+    def setUpZope(self, app, configurationContext):
+        import pcp.contenttypes
+        import pcp.spmtsync
+        self.loadZCML(package=pcp.contenttypes)
+        self.loadZCML(package=pcp.spmtsync)
+        z2.installProduct(app, 'pcp.contenttypes')
+
+    def setUpPloneSite(self, portal):
+        applyProfile(portal, 'pcp.contenttypes:default')
+        applyProfile(portal, 'pcp.spmtsync:default')
+
+    def tearDownZope(self, app):
+        z2.uninstallProduct(app, 'pcp.contenttypes')
+
+
+SPMTSYNC_FIXTURE = SPMTSyncLayer()
+SPMTSYNC_FUNCTIONAL_TESTING = FunctionalTesting(
+    bases=(SPMTSYNC_FIXTURE,), name='SPMTSyncLayer:Functional')
+
+
+class SPMTSyncTestCase(unittest.TestCase):
+    """Base of the tests syncing synthetic portfolios served by SPMTStub"""
+
+    layer = SPMTSYNC_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        if 'portal' not in self.layer:
+            self.skipTest('needs the layer support of zope-testrunner')
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        login(self.layer['app'], SITE_OWNER_NAME)
+        self.cachedir = tempfile.mkdtemp()
+        self.stub = SPMTStub().start()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.cachedir)
+
+    def setup_site(self, portfolio):
+        registry = getUtility(IRegistry)
+        registry['pcp.spmtsync.portfoliourl'] = portfolio.portfolio_url
+        registry['pcp.spmtsync.cachedir'] = self.cachedir
+        registry['pcp.spmtsync.logfile'] = os.path.join(self.cachedir,
+                                                        'spmtsync.log')
+        if 'people' not in self.portal:
+            plone.api.content.create(
+                container=self.portal, type='Folder', id='people')
+        for i in range(0, portfolio.size, portfolio.contacts):
+            plone.api.content.create(
+                container=self.portal.people, type='Person',
+                id='person-%d-%d' % (portfolio.size, i),
+                email='person-%d@example.org' % i)
+        folder = plone.api.content.create(
+            container=self.portal, type='Folder',
+            id='portfolio-%d' % portfolio.size)
+        alsoProvides(folder, IPortfolioRoot)
+        transaction.commit()
+        return folder
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+==============================
+Local stand-in for the SPMT API
+==============================
+
+``SyntheticPortfolio`` generates the SPMT documents the sync reads (the
+portfolio listing, contacts, service details, components, implementations
+and implementation details) for a given number of services and fan-out.
+``SPMTStub`` serves them over HTTP on localhost - with ETags, so
+conditional requests are answered with ``304 Not Modified`` - and counts
+the requests it gets.
+"""
+import hashlib
+import json
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+LINK_FIELDS = [
+    'usage_policy_link',
+    'user_documentation_link',
+    'operations_documentation_link',
+    'monitoring_link',
+    'accounting_link',
+    'business_continuity_plan_link',
+    'disaster_recovery_plan_link',
+    'decommissioning_procedure_link',
+]
+
+
+def link(href):
+    return {'related': {'href': href}}
+
+
+class SyntheticPortfolio(object):
+    """SPMT documents of `size` services, each with `components`
+    components of `implementations` implementations of `versions`
+    implementation details. Every service depends on its predecessor and
+    every `contacts`-th service shares its contact."""
+
+    def __init__(self, base_url, size=10, components=2, implementations=2,
+                 versions=2, contacts=5):
+        self.base_url = base_url.rstrip('/')
+        self.size = size
+        self.components = components
+        self.implementations = implementations
+        self.versions = versions
+        self.contacts = contacts
+        self.revision = 0
+        self.documents = {}
+        self.generate()
+
+    @property
+    def portfolio_url(self):
+        return self.url('/portfolio/services')
+
+    def url(self, path):
+        return self.base_url + path
+
+    def add(self, path, data):
+        self.documents[path] = {'data': data}
+
+    def generate(self):
+        services = [self.service(i) for i in range(self.size)]
+        self.add('/portfolio/services', {'services': services})
+        for i in range(0, self.size, self.contacts):
+            self.add('/contacts/%d' % i, {
+                'external_contact_information': {
+                    'email': 'person-%d@example.org' % i}})
+
+    def service(self, i):
+        uuid = 'service-%d' % i
+        details_path = '/services/%s/details' % uuid
+        details = {
+            'uuid': uuid + '-details',
+            'version': '1.0',
+            'links': {'self': self.url(details_path)},
+            'dependencies_list': {'services': [
+                {'service': {'name': 'Service %d' % (i - 1),
+                             'uuid': 'service-%d' % (i - 1)}}]
+                if i else []},
+        }
+        for field in LINK_FIELDS:
+            details[field] = link('https://docs.example.org/%s/%s'
+                                  % (uuid, field))
+        components = [self.component(uuid, j)
+                      for j in range(self.components)]
+        self.add(details_path, {'service_components_list': {
+            'service_components': [{'component': c} for c in components]}})
+        contact = i - i % self.contacts
+        return {
+            'name': 'Service %d' % i,
+            'uuid': uuid,
+            'description_external': 'Synthetic service %d' % i,
+            'service_complete_link': link(self.url('/services/' + uuid)),
+            'contact_information': {
+                'links': {'self': self.url('/contacts/%d' % contact)}},
+            'service_owner': {'email': 'person-%d@example.org' % contact},
+            'service_details_list': {'service_details': [details]},
+        }
+
+    def component(self, service_uuid, j):
+        uuid = '%s-component-%d' % (service_uuid, j)
+        path = '/components/%s/implementations' % uuid
+        implementations = [self.implementation(uuid, k)
+                           for k in range(self.implementations)]
+        self.add(path, {'service_component_implementations_list': {
+            'service_component_implementations': implementations}})
+        return {
+            'name': 'Component %s' % uuid,
+            'uuid': uuid,
+            'service_component_implementations_link': link(self.url(path)),
+        }
+
+    def implementation(self, component_uuid, k):
+        uuid = '%s-implementation-%d' % (component_uuid, k)
+        path = '/implementations/%s/details' % uuid
+        self.add(path, {'service_component_implementation_details_list': {
+            'service_component_implementation_details': [
+                {'uuid': '%s-version-%d' % (uuid, v),
+                 'version': '%d.0' % v,
+                 'configuration_parameters': 'port 80\nhost localhost'}
+                for v in range(self.versions)]}})
+        return {
+            'name': 'Implementation %s' % uuid,
+            'uuid': uuid,
+            'component_implementation_details_link': link(self.url(path)),
+        }
+
+    def change(self, count=1):
+        """Change the description of the first `count` services"""
+        self.revision += 1
+        portfolio = self.documents['/portfolio/services']['data']
+        for entry in portfolio['services'][:count]:
+            entry['description_external'] = 'Synthetic service, revision %d' \
+                % self.revision
+
+    def add_version(self, count=1):
+        """Add a version to the first implementation of the first component
+        of the first `count` services"""
+        self.revision += 1
+        for i in range(count):
+            uuid = 'service-%d-component-0-implementation-0' % i
+            versions = self.documents['/implementations/%s/details' % uuid][
+                'data']['service_component_implementation_details_list'][
+                'service_component_implementation_details']
+            versions.append({'uuid': '%s-version-r%d' % (uuid, self.revision),
+                             'version': '%d.0' % len(versions),
+                             'configuration_parameters': 'port 80'})
+
+    def components_of(self, i):
+        return self.documents['/services/service-%d/details' % i]['data'][
+            'service_components_list']['service_components']
+
+    def rename_component(self, i, name):
+        """Rename the first component of service `i` to `name`"""
+        self.components_of(i)[0]['component']['name'] = name
+
+    def share_component(self, i, j):
+        """List the first component of service `i` for service `j` too"""
+        self.components_of(j).append(self.components_of(i)[0])
+
+
+class SPMTStub(object):
+    """Serve the documents of a `SyntheticPortfolio` on localhost.
+    Use as context manager or call `start` and `stop`."""
+
+    def __init__(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.stub = self
+        self.documents = {}
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/api/v1' % self.server.server_address[1]
+
+    def serve(self, portfolio):
+        self.documents = portfolio.documents
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = self.not_modified = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stub = self.server.stub
+        with stub._lock:
+            stub.requests += 1
+        path = self.path.split('?')[0]
+        if path.startswith('/api/v1'):
+            path = path[len('/api/v1'):]
+        document = stub.documents.get(path)
+        if document is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(document, sort_keys=True).encode('utf8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            with stub._lock:
+                stub.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the circuit breaker around SPMT requests"""
+
+import sys
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.browser.breaker import CircuitBreaker
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Opening after repeated failures and recovering after a while
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(threshold=3, reset_after=10,
+                                      clock=self.clock)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.trips, 1)
+
+    def test_half_open(self):
+        for i in range(3):
+            self.breaker.failure()
+        self.clock.now = 10
+        # a single trial call is let through
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.failure()
+        self.clock.now = 15
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.trips, 1)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(threshold=0)
+        for i in range(100):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the options and exit status of the console script"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+from pcp.spmtsync import console
+from pcp.spmtsync.browser.snapshots import Snapshot
+
+PORTFOLIO = 'https://sp.eudat.eu/api/v1/portfolio/services'
+
+
+class ConsoleTest(unittest.TestCase):
+    """Checking the command line without Zope
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.directory)
+
+    def snapshot(self, name, **documents):
+        path = os.path.join(self.directory, name)
+        documents[PORTFOLIO] = {'services': []}
+        Snapshot(PORTFOLIO, documents).save(path)
+        return path
+
+    def test_wrong_usage(self):
+        for argv in [[],
+                     ['--unknown', '/Plone/services'],
+                     ['--services', 'b2safe', '--dry-run', '/Plone/services'],
+                     ['--services', 'b2safe', '--force', '/Plone/services'],
+                     ['--dry-run', '/Plone/services', '/Other/services'],
+                     ['--export', 'x.jsonl.gz', '/Plone/a', '/Plone/b'],
+                     ['--partitions', '2', '/Plone/a', '/Plone/b'],
+                     ['--partitions', '0', '/Plone/services'],
+                     ['--partitions', '2', '--streaming', '/Plone/services'],
+                     ['--partition', '/Plone/services'],
+                     # neither run through bin/instance nor --zope-conf
+                     ['/Plone/services']]:
+            self.assertEqual(console.main(argv), console.EXIT_USAGE, argv)
+
+    def test_help(self):
+        self.assertEqual(console.main(['--help']), console.EXIT_OK)
+
+    def test_diff(self):
+        old = self.snapshot('old.jsonl.gz', a={'name': 'A'})
+        same = self.snapshot('same.jsonl.gz', a={'name': 'A'})
+        new = self.snapshot('new.jsonl.gz', a={'name': 'B'})
+        self.assertEqual(console.main(['--diff', old, same]), console.EXIT_OK)
+        sys.stdout = StringIO()
+        self.assertEqual(console.main(['--diff', old, new]),
+                         console.EXIT_CHANGED)
+        self.assertEqual(json.loads(sys.stdout.getvalue())['changed'], ['a'])
+
+    def test_diff_unreadable(self):
+        old = self.snapshot('old.jsonl.gz')
+        missing = os.path.join(self.directory, 'missing.jsonl.gz')
+        self.assertEqual(console.main(['--diff', old, missing]),
+                         console.EXIT_ERROR)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the fan-out and the partitions of one snapshot"""
+
+import sys
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.coordinator import fanOut
+from pcp.spmtsync.coordinator import runPartitions
+from pcp.spmtsync.coordinator import workerArguments
+
+# a stand-in for the console script: echoes its arguments as "summary"
+# and fails for folders in /Broken
+WORKER = [sys.executable, '-c',
+          'import json, sys\n'
+          'print(json.dumps(sys.argv[1:]))\n'
+          'sys.exit(1 if sys.argv[-1].startswith("/Broken") else 0)\n']
+
+
+class CoordinatorTest(unittest.TestCase):
+    """Worker command lines and collecting the workers' results
+    """
+    def test_worker_arguments(self):
+        self.assertEqual(
+            workerArguments(['bin/spmtsync'], '/Plone/services', 'spmt.gz',
+                            zope_conf='zope.conf', user='admin',
+                            incremental=True, commit_every=10),
+            ['bin/spmtsync', '--zope-conf', 'zope.conf', '--user', 'admin',
+             '--incremental', '--commit-every', '10',
+             '--snapshot', 'spmt.gz', '/Plone/services'])
+
+    def test_fan_out(self):
+        results = fanOut(WORKER, ['/Plone/services', '/Broken/services'],
+                         'spmt.gz', workers=2, incremental=True)
+        self.assertEqual(results['/Plone/services'],
+                         {'status': 0,
+                          'summary': ['--incremental', '--snapshot',
+                                      'spmt.gz', '/Plone/services']})
+        self.assertEqual(results['/Broken/services']['status'], 1)
+
+    def test_partitions(self):
+        results = runPartitions(WORKER, '/Plone/services', 'spmt.gz',
+                                [['a', 'c'], ['b']], workers=2)
+        self.assertEqual([result['summary'] for result in results], [
+            ['--partition', '--services', 'a,c', '--snapshot', 'spmt.gz',
+             '/Plone/services'],
+            ['--partition', '--services', 'b', '--snapshot', 'spmt.gz',
+             '/Plone/services']])
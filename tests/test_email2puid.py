@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of mapping contact emails to Persons"""
+
+import sys
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from BTrees.Length import Length
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getGlobalSiteManager
+from zope.component.hooks import setSite
+from zope.interface import implementer
+
+from pcp.spmtsync.browser import config
+from pcp.spmtsync.browser import utils
+
+# stands in for Missing.Value in the metadata of brains cataloged before
+# the getEmail column was added
+MISSING = object()
+
+
+@implementer(IAnnotations)
+class DummyFolder(dict):
+
+    def __init__(self, path, **items):
+        super(DummyFolder, self).__init__()
+        self.path = path
+        for name, value in items.items():
+            setattr(self, name, value)
+
+    def getPhysicalPath(self):
+        return tuple(self.path.split('/'))
+
+    def _getOb(self, id, default=None):
+        return getattr(self, id, default)
+
+    def getSiteManager(self):
+        return getGlobalSiteManager()
+
+
+class DummyPerson(object):
+
+    portal_type = 'Person'
+
+    def __init__(self, email):
+        self.email = email
+
+    def getEmail(self):
+        return self.email
+
+
+class DummyBrain(object):
+
+    def __init__(self, uid, email, column=True):
+        self.UID = uid
+        self.getEmail = email if column else MISSING
+        self.person = DummyPerson(email)
+
+    def _unrestrictedGetObject(self):
+        return self.person
+
+
+class DummyCatalog(object):
+
+    def __init__(self, *brains):
+        self.brains = list(brains)
+        self.searches = 0
+
+    def schema(self):
+        return ['getEmail']
+
+    def unrestrictedSearchResults(self, **query):
+        self.searches += 1
+        return self.brains
+
+
+class Email2puidTest(unittest.TestCase):
+    """Mapping emails to Person UIDs, cached across syncs
+    """
+    def setUp(self):
+        self.creg2dp_email = config.creg2dp_email
+        config.creg2dp_email = {'old@rzg.mpg.de': 'new@mpcdf.mpg.de',
+                                'Jane@SPMT.org': 'jane@dpmt.org'}
+        utils._email2puid_cache.clear()
+        self.catalog = DummyCatalog()
+        self.site = DummyFolder(
+            '/plone', people=DummyFolder('/plone/people'),
+            portal_catalog=self.catalog)
+
+    def tearDown(self):
+        config.creg2dp_email = self.creg2dp_email
+        utils._email2puid_cache.clear()
+        setSite(None)
+
+    def test_mapping(self):
+        self.catalog.brains = [DummyBrain('uid-1', 'John@Example.org'),
+                               DummyBrain('uid-2', 'john@example.org'),
+                               DummyBrain('uid-3', 'ann@example.org',
+                                          column=False)]
+        self.assertEqual(utils.email2puid(self.site),
+                         {'john@example.org': 'uid-1',
+                          'ann@example.org': 'uid-3'})
+
+    def test_exceptions_both_ways(self):
+        self.catalog.brains = [DummyBrain('uid-new', 'new@mpcdf.mpg.de'),
+                               DummyBrain('uid-jane', 'jane@spmt.org')]
+        mapping = utils.email2puid(self.site)
+        self.assertEqual(mapping['old@rzg.mpg.de'], 'uid-new')
+        self.assertEqual(mapping['new@mpcdf.mpg.de'], 'uid-new')
+        self.assertEqual(mapping['jane@dpmt.org'], 'uid-jane')
+        self.assertEqual(mapping['jane@spmt.org'], 'uid-jane')
+
+    def test_cached_until_a_person_changes(self):
+        self.catalog.brains = [DummyBrain('uid-1', 'john@example.org')]
+        mapping = utils.email2puid(self.site)
+        self.assertIs(utils.email2puid(self.site), mapping)
+        self.assertEqual(self.catalog.searches, 1)
+
+        self.catalog.brains.append(DummyBrain('uid-2', 'ann@example.org'))
+        setSite(self.site)
+        utils.invalidateEmail2puid(DummyFolder('/plone/other'), None)
+        self.assertIs(utils.email2puid(self.site), mapping)
+        utils.invalidateEmail2puid(self.catalog.brains[1].person, None)
+        self.assertEqual(utils.email2puid(self.site)['ann@example.org'],
+                         'uid-2')
+        self.assertEqual(
+            IAnnotations(self.site.people)[utils.PEOPLE_VERSION_KEY](), 1)
+
+    def test_invalidated_by_other_clients(self):
+        self.catalog.brains = [DummyBrain('uid-1', 'john@example.org')]
+        utils.email2puid(self.site)
+        # another ZEO client only changes the people version
+        self.catalog.brains = [DummyBrain('uid-2', 'john@example.org')]
+        IAnnotations(self.site.people)[utils.PEOPLE_VERSION_KEY] = Length(1)
+        self.assertEqual(utils.email2puid(self.site)['john@example.org'],
+                         'uid-2')
+        self.assertEqual(self.catalog.searches, 2)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of fetching and memoizing SPMT documents"""
+
+import sys
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.browser.fetch import ContactResolver
+from pcp.spmtsync.browser.fetch import SPMTFetcher
+
+BASE = 'https://sp.eudat.eu/api/v1/portfolio/'
+
+
+class DummyResponse(object):
+
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.content = b'{}'
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+
+class DummySession(object):
+    """Answers the requests from the mapping URL -> response (or
+    exception to raise) and records the URLs requested"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.requested = []
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        self.requested.append(url)
+        answer = self.answers[url]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def fetcher(answers, concurrency=1):
+    result = SPMTFetcher(concurrency=concurrency, retries=0)
+    result.session = DummySession(answers)
+    return result
+
+
+def document(data):
+    return DummyResponse(body={'data': data})
+
+
+class SPMTFetcherTest(unittest.TestCase):
+    """Memoizing, copying and failing SPMT documents
+    """
+    def test_memoized_and_copied(self):
+        spmt = fetcher({BASE + 'a': document({'name': 'A', 'list': []})})
+        data = spmt.get(BASE + 'a')
+        data['name'] = 'changed'
+        data['list'].append(1)
+        self.assertEqual(spmt.get(BASE + 'a'), {'name': 'A', 'list': []})
+        self.assertEqual(spmt.session.requested, [BASE + 'a'])
+
+    def test_fetch_all_keeps_the_order(self):
+        urls = [BASE + str(i) for i in range(10)]
+        spmt = fetcher(dict((url, document(url)) for url in urls),
+                       concurrency=4)
+        self.assertEqual(spmt.fetch_all(urls[::-1] + [None, urls[0]]),
+                         urls[::-1] + [urls[0]])
+        self.assertEqual(sorted(spmt.session.requested), sorted(urls))
+
+    def test_failures_are_recorded(self):
+        spmt = fetcher({BASE + 'missing': DummyResponse(404),
+                        BASE + 'broken': KeyError('boom')})
+        self.assertEqual(spmt.fetch_all([BASE + 'missing', BASE + 'broken']),
+                         [None, None])
+        self.assertEqual(spmt.failed, {BASE + 'missing': 'HTTP 404',
+                                       BASE + 'broken': 'KeyError'})
+        # failures are memoized as well
+        self.assertEqual(spmt.get(BASE + 'missing'), None)
+        self.assertEqual(len(spmt.session.requested), 2)
+
+    def test_clear_keeps_failures(self):
+        spmt = fetcher({BASE + 'a': document(1),
+                        BASE + 'missing': DummyResponse(500)})
+        spmt.fetch_all([BASE + 'a', BASE + 'missing'])
+        spmt.clear()
+        self.assertEqual(spmt.documents(), {})
+        self.assertEqual(list(spmt.failed), [BASE + 'missing'])
+
+
+def entry(contact):
+    return {'contact_information': {'links': {'self': BASE + contact}}}
+
+
+def contact(email):
+    return document({'external_contact_information': {'email': email}})
+
+
+class ContactResolverTest(unittest.TestCase):
+    """Resolving the contacts of portfolio entries to Person UIDs
+    """
+    def test_contacts_fetched_once(self):
+        spmt = fetcher({BASE + 'c1': contact('Jane@example.org'),
+                        BASE + 'c2': contact('nobody@example.org')},
+                       concurrency=2)
+        resolver = ContactResolver(spmt, {'jane@example.org': 'uid-jane'})
+        resolver.prefetch([entry('c1'), entry('c2'), entry('c1'), {}])
+        resolver.prefetch([entry('c1')])
+        self.assertEqual(sorted(spmt.session.requested),
+                         [BASE + 'c1', BASE + 'c2'])
+        self.assertEqual(resolver.resolve(BASE + 'c1'),
+                         ('Jane@example.org', 'uid-jane'))
+        self.assertEqual(resolver.resolve(BASE + 'c2'),
+                         ('nobody@example.org', None))
+        self.assertEqual(len(spmt.session.requested), 2)
+
+    def test_unavailable_contact(self):
+        spmt = fetcher({BASE + 'c': DummyResponse(404)})
+        resolver = ContactResolver(spmt, {})
+        self.assertEqual(resolver.resolve(BASE + 'c'),
+                         ('noreply@nowhere.org', None))
+        self.assertEqual(resolver.mapping(), {'noreply@nowhere.org': None})
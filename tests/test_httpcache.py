@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the SPMT response cache"""
+
+import os
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.browser.httpcache import ResponseCache
+
+
+class DummyResponse(object):
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """Storing, revalidating and evicting cached SPMT responses
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        cache = ResponseCache(self.directory)
+        url = 'https://sp.eudat.eu/api/v1/portfolio/services'
+        response = DummyResponse(ETag='"abc"',
+                                 **{'Last-Modified': 'Mon, 01 Jan 2018'})
+        cache.store(url, response, {'data': {'services': []}})
+        entry = cache.lookup(url)
+        self.assertEqual(entry['body'], {'data': {'services': []}})
+        self.assertEqual(cache.conditional_headers(entry),
+                         {'If-None-Match': '"abc"',
+                          'If-Modified-Since': 'Mon, 01 Jan 2018'})
+
+    def test_no_validators_not_cached(self):
+        cache = ResponseCache(self.directory)
+        cache.store('http://x', DummyResponse(), {'data': 1})
+        self.assertEqual(cache.lookup('http://x'), None)
+        self.assertEqual(cache.conditional_headers(None), {})
+
+    def test_lru_eviction(self):
+        body = {'data': 'x' * 100}
+        cache = ResponseCache(self.directory)
+        cache.store('http://a', DummyResponse(ETag='0'), body)
+        # room for exactly three entries
+        cache.max_size = 3 * os.stat(cache._path('http://a')).st_size
+        for i, url in enumerate(['http://a', 'http://b', 'http://c']):
+            cache.store(url, DummyResponse(ETag=str(i)), body)
+            os.utime(cache._path(url), (i, i))
+        # touching 'a' makes 'b' the least recently used entry
+        cache.lookup('http://a')
+        cache.store('http://d', DummyResponse(ETag='3'), body)
+        self.assertEqual(cache.lookup('http://b'), None)
+        self.assertNotEqual(cache.lookup('http://a'), None)
+        self.assertNotEqual(cache.lookup('http://d'), None)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Functional tests of incremental syncs against the local SPMT stand-in
+(see ``functional.py``)"""
+
+import transaction
+
+from Products.PlonePAS.utils import cleanId
+
+from functional import SPMTSyncTestCase
+from spmtstub import SyntheticPortfolio
+
+
+class IncrementalSyncTest(SPMTSyncTestCase):
+    """Incremental syncs keep what did not change and pick up the rest
+    """
+    def sync(self, folder, **options):
+        from pcp.spmtsync.browser.sync import SPMTSyncView
+        view = SPMTSyncView(folder, self.request)
+        view.sync(**options)
+        transaction.commit()
+        return view
+
+    def synced_portfolio(self):
+        portfolio = SyntheticPortfolio(self.stub.base_url, 3, 2, 2, 2)
+        self.stub.serve(portfolio)
+        folder = self.setup_site(portfolio)
+        self.assertTrue(self.sync(folder).metrics.counters.get('created'))
+        return portfolio, folder
+
+    def test_noop_incremental_sync_privatises_nothing(self):
+        portfolio, folder = self.synced_portfolio()
+        view = self.sync(folder, incremental=True)
+        self.assertEqual(view.metrics.counters.get('privatised', 0), 0)
+        self.assertEqual(view.metrics.counters.get('created', 0), 0)
+        self.assertTrue(view.metrics.counters.get('unchanged'))
+
+    def test_changed_description(self):
+        portfolio, folder = self.synced_portfolio()
+        portfolio.change(1)
+        view = self.sync(folder, incremental=True)
+        self.assertEqual(view.metrics.counters.get('created', 0), 0)
+        self.assertEqual(view.metrics.counters.get('privatised', 0), 0)
+        self.assertEqual(folder[cleanId('Service 0')].getDescription(),
+                         'Synthetic service, revision 1')
+
+    def test_new_version(self):
+        portfolio, folder = self.synced_portfolio()
+        portfolio.add_version(1)
+        view = self.sync(folder, incremental=True)
+        self.assertEqual(view.metrics.counters.get('created', 0), 1)
+        self.assertEqual(view.metrics.counters.get('privatised', 0), 0)
+        uuid = 'service-0-component-0'
+        implementation = folder[cleanId('Service 0')][
+            cleanId('Component ' + uuid)][
+            cleanId('Implementation ' + uuid + '-implementation-0')]
+        self.assertIn(cleanId('version-2.0'), implementation.objectIds())
+        # the other services were skipped
+        self.assertTrue(view.metrics.counters.get('unchanged'))
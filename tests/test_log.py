@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the sync logging"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from logging.handlers import RotatingFileHandler
+
+from pcp.spmtsync.browser import log
+
+
+class Collector(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class LoggingTest(unittest.TestCase):
+    """Lazy configuration, truncated payloads and sampling
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logger = logging.getLogger(log.LOGGER_NAME)
+        self.collector = Collector()
+        self.logger.addHandler(self.collector)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.collector)
+        log.configureLogging(None, level='WARNING')
+        shutil.rmtree(self.directory)
+
+    def handlers(self, cls):
+        return [handler for handler in self.logger.handlers
+                if isinstance(handler, cls)]
+
+    def test_configure_once(self):
+        logfile = os.path.join(self.directory, 'spmtsync.log')
+        log.configureLogging(logfile, level='DEBUG')
+        log.configureLogging(logfile, level='DEBUG')
+        self.assertEqual(len(self.handlers(RotatingFileHandler)), 1)
+        self.assertEqual(self.logger.level, logging.DEBUG)
+        log.configureLogging(logfile, level='INFO')
+        self.assertEqual(len(self.handlers(RotatingFileHandler)), 1)
+        self.assertFalse(self.logger.isEnabledFor(logging.DEBUG))
+
+    def test_missing_directory(self):
+        log.configureLogging(os.path.join(self.directory, 'no', 'sync.log'))
+        self.assertEqual(self.handlers(RotatingFileHandler), [])
+
+    def test_payload(self):
+        payload = log.Payload({'name': 'x' * 50}, limit=20)
+        self.assertTrue(str(payload).startswith("{'name': 'xxxxxxxxxx"))
+        self.assertTrue(str(payload).endswith('... (62 characters)'))
+        self.assertEqual(str(log.Payload([1, 2])), '[1, 2]')
+
+    def test_sampling(self):
+        log.configureLogging(None, level='DEBUG', sample=3)
+        for i in range(7):
+            self.logger.debug('data: %s', log.Payload(i))
+        self.logger.debug('no payload')
+        self.assertEqual(self.collector.messages,
+                         ['data: 0', 'data: 3', 'data: 6', 'no payload'])
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the sync metrics"""
+
+import json
+import sys
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.browser.metrics import SyncMetrics
+
+
+class SyncMetricsTest(unittest.TestCase):
+    """Phases, counters and the slowest SPMT URLs of a sync run
+    """
+    def test_phases_and_counters(self):
+        metrics = SyncMetrics()
+        with metrics.phase('fetch'):
+            self.assertEqual(metrics.current_phase, 'fetch')
+            with metrics.phase('contacts'):
+                self.assertEqual(metrics.current_phase, 'contacts')
+        with metrics.phase('fetch'):
+            pass
+        metrics.count('created')
+        metrics.count('created', 2)
+        summary = metrics.summary()
+        self.assertEqual(metrics.current_phase, None)
+        self.assertEqual(list(summary['phases']), ['contacts', 'fetch'])
+        self.assertEqual(summary['phases']['fetch']['calls'], 2)
+        self.assertEqual(summary['counters'], {'created': 3})
+        # the summary must be serializable
+        json.dumps(summary)
+
+    def test_slowest_urls(self):
+        metrics = SyncMetrics(slowest=2)
+        metrics.record_fetch('http://a', 0.5, 10, 200)
+        metrics.record_fetch('http://b', 2.0, 20, 200)
+        metrics.record_fetch('http://c', 1.0, 0, 304)
+        summary = metrics.summary()
+        self.assertEqual([entry['url'] for entry in summary['slowest_urls']],
+                         ['http://b', 'http://c'])
+        self.assertEqual(summary['bytes_downloaded'], 30)
+        self.assertEqual(summary['counters'],
+                         {'fetches': 3, 'not_modified': 1})
+
+    def test_failed_urls(self):
+        metrics = SyncMetrics()
+        metrics.record_failure('http://a', 'Timeout after 4 attempts')
+        metrics.record_failure('http://b', 'HTTP 404')
+        summary = metrics.summary()
+        self.assertEqual(summary['failed_urls'],
+                         [{'url': 'http://a',
+                           'reason': 'Timeout after 4 attempts'},
+                          {'url': 'http://b', 'reason': 'HTTP 404'}])
+        self.assertEqual(summary['counters'], {'failed_fetches': 2})
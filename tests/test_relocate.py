@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Functional tests of syncing objects renamed or moved in SPMT (see
+``functional.py``)"""
+
+import transaction
+
+from zope.annotation.interfaces import IAnnotations
+from Products.PlonePAS.utils import cleanId
+
+from functional import SPMTSyncTestCase
+from spmtstub import SyntheticPortfolio
+
+
+class RelocateTest(SPMTSyncTestCase):
+    """Objects are tracked by their SPMT uuid
+    """
+    def sync(self, folder, **options):
+        from pcp.spmtsync.browser.sync import SPMTSyncView
+        view = SPMTSyncView(folder, self.request)
+        view.sync(**options)
+        transaction.commit()
+        return view
+
+    def synced_portfolio(self):
+        portfolio = SyntheticPortfolio(self.stub.base_url, 2, 1, 1, 1)
+        self.stub.serve(portfolio)
+        folder = self.setup_site(portfolio)
+        self.sync(folder)
+        return portfolio, folder
+
+    def service(self, folder, i):
+        return folder[cleanId('Service %d' % i)]
+
+    def test_renamed_component(self):
+        portfolio, folder = self.synced_portfolio()
+        portfolio.rename_component(0, 'Renamed')
+        view = self.sync(folder)
+        self.assertEqual(view.metrics.counters.get('moved'), 1)
+        self.assertEqual(view.metrics.counters.get('created', 0), 0)
+        self.assertIn(cleanId('Renamed'), self.service(folder, 0))
+
+    def test_renamed_component_before_the_index(self):
+        from pcp.spmtsync.browser.sync import UUIDS_KEY
+        portfolio, folder = self.synced_portfolio()
+        del IAnnotations(folder)[UUIDS_KEY]
+        transaction.commit()
+        portfolio.rename_component(0, 'Renamed')
+        view = self.sync(folder)
+        self.assertEqual(view.metrics.counters.get('moved'), 1)
+        self.assertIn(UUIDS_KEY, IAnnotations(folder))
+
+    def test_shared_component_stays(self):
+        portfolio, folder = self.synced_portfolio()
+        portfolio.share_component(0, 1)
+        component = cleanId('Component service-0-component-0')
+        view = self.sync(folder)
+        self.assertEqual(view.metrics.counters.get('moved', 0), 0)
+        self.assertIn(component, self.service(folder, 0))
+        self.assertIn(component, self.service(folder, 1))
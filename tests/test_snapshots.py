@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the SPMT snapshots"""
+
+import os
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+from pcp.spmtsync.browser.snapshots import Snapshot
+from pcp.spmtsync.browser.snapshots import SnapshotFetcher
+from pcp.spmtsync.browser.snapshots import diffSnapshots
+from pcp.spmtsync.browser.snapshots import readHeader
+
+PORTFOLIO = 'https://sp.eudat.eu/api/v1/portfolio/services'
+DETAILS = 'https://sp.eudat.eu/api/v1/services/b2safe/details'
+
+
+def documents():
+    return {
+        PORTFOLIO: {'services': [{'name': 'B2SAFE', 'uuid': 'b2safe'}]},
+        DETAILS: {'service_components_list': None},
+    }
+
+
+class SnapshotTest(unittest.TestCase):
+    """Writing, reading and comparing snapshots of the SPMT data
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_roundtrip(self):
+        snapshot = Snapshot(PORTFOLIO, documents(), failed=['http://x'])
+        snapshot.save(self.path('spmt.jsonl.gz'))
+        header = readHeader(self.path('spmt.jsonl.gz'))
+        self.assertEqual(header['digest'], snapshot.digest)
+        self.assertEqual(header['documents'], 2)
+        loaded = Snapshot.load(self.path('spmt.jsonl.gz'))
+        self.assertEqual(loaded.documents, documents())
+        self.assertEqual(loaded.failed, ['http://x'])
+        self.assertEqual(loaded.digest, snapshot.digest)
+        self.assertEqual(loaded.services(),
+                         [{'name': 'B2SAFE', 'uuid': 'b2safe'}])
+
+    def test_not_a_snapshot(self):
+        import gzip
+        with gzip.open(self.path('other.gz'), 'wb') as fp:
+            fp.write(b'{"format": "other"}\n')
+        self.assertRaises(ValueError, Snapshot.load, self.path('other.gz'))
+
+    def test_diff(self):
+        Snapshot(PORTFOLIO, documents()).save(self.path('old.jsonl.gz'))
+        Snapshot(PORTFOLIO, documents()).save(self.path('same.jsonl.gz'))
+        changed = documents()
+        changed[PORTFOLIO]['services'][0]['name'] = 'B2SAFE 2'
+        del changed[DETAILS]
+        changed['http://new'] = {}
+        Snapshot(PORTFOLIO, changed).save(self.path('new.jsonl.gz'))
+        self.assertEqual(diffSnapshots(self.path('old.jsonl.gz'),
+                                       self.path('same.jsonl.gz')),
+                         {'added': [], 'removed': [], 'changed': []})
+        self.assertEqual(diffSnapshots(self.path('old.jsonl.gz'),
+                                       self.path('new.jsonl.gz')),
+                         {'added': ['http://new'],
+                          'removed': [DETAILS],
+                          'changed': [PORTFOLIO]})
+
+    def test_fetcher(self):
+        snapshot = Snapshot(PORTFOLIO, documents())
+        fetcher = SnapshotFetcher(snapshot)
+        data = fetcher.get(DETAILS)
+        data['modified'] = True
+        # the snapshot is not affected by changes of the sync
+        self.assertEqual(fetcher.get(DETAILS),
+                         {'service_components_list': None})
+        self.assertEqual(fetcher.get('http://missing'), None)
+        self.assertEqual(list(fetcher.failed), ['http://missing'])
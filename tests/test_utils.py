@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Unit tests of the requests to SPMT and other helpers"""
+
+import shutil
+import sys
+import tempfile
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
+
+import requests
+
+from pcp.spmtsync.browser.httpcache import ResponseCache
+from pcp.spmtsync.browser.metrics import SyncMetrics
+from pcp.spmtsync.browser.utils import SPMTFetchError
+from pcp.spmtsync.browser.utils import SpooledList
+from pcp.spmtsync.browser.utils import checkDependencies
+from pcp.spmtsync.browser.utils import chunked
+from pcp.spmtsync.browser.utils import findCycles
+from pcp.spmtsync.browser.utils import requestSPMT
+
+URL = 'https://sp.eudat.eu/api/v1/portfolio/services'
+
+
+class DummyResponse(object):
+
+    def __init__(self, status_code=200, body=None, content=None, **headers):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.content = content if content is not None else b'{}'
+        self.headers = headers
+
+    def json(self):
+        if self.body is None:
+            raise ValueError('No JSON object could be decoded')
+        return self.body
+
+    def close(self):
+        pass
+
+
+class DummySession(object):
+    """Answers the requests with `answers` in turn - responses or
+    exceptions to raise - and records the headers sent"""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.headers = []
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        self.headers.append(headers)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class RequestSPMTTest(unittest.TestCase):
+    """Retries, errors and the response cache of requestSPMT
+    """
+    def request(self, session, **options):
+        options.setdefault('backoff', 0)
+        return requestSPMT(URL, session=session, **options)
+
+    def test_success(self):
+        session = DummySession(DummyResponse(body={'data': 1}))
+        self.assertEqual(self.request(session), {'data': 1})
+
+    def test_retries_transient_status_and_errors(self):
+        metrics = SyncMetrics()
+        session = DummySession(DummyResponse(503),
+                               requests.ConnectionError(),
+                               DummyResponse(body={'data': 1}))
+        self.assertEqual(self.request(session, retries=2, metrics=metrics),
+                         {'data': 1})
+        self.assertEqual(metrics.counters['retries'], 2)
+
+    def test_gives_up_with_the_last_reason(self):
+        session = DummySession(requests.Timeout(), DummyResponse(502))
+        with self.assertRaises(SPMTFetchError) as raised:
+            self.request(session, retries=1)
+        self.assertEqual(str(raised.exception), 'HTTP 502 after 2 attempts')
+
+    def test_no_retry_on_other_errors(self):
+        session = DummySession(DummyResponse(404), DummyResponse(body={}))
+        with self.assertRaises(SPMTFetchError) as raised:
+            self.request(session, retries=3)
+        self.assertEqual(str(raised.exception), 'HTTP 404')
+        self.assertEqual(len(session.answers), 1)
+
+        session = DummySession(requests.TooManyRedirects(),
+                               DummyResponse(body={}))
+        with self.assertRaises(SPMTFetchError) as raised:
+            self.request(session, retries=3)
+        self.assertEqual(str(raised.exception), 'TooManyRedirects')
+
+    def test_invalid_json(self):
+        session = DummySession(DummyResponse(body=None))
+        with self.assertRaises(SPMTFetchError) as raised:
+            self.request(session)
+        self.assertEqual(str(raised.exception), 'Invalid JSON')
+
+    def test_not_modified_from_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = ResponseCache(directory)
+        session = DummySession(DummyResponse(body={'data': 1}, ETag='"v1"'),
+                               DummyResponse(304))
+        self.assertEqual(self.request(session, cache=cache), {'data': 1})
+        self.assertEqual(self.request(session, cache=cache), {'data': 1})
+        self.assertEqual(session.headers, [{}, {'If-None-Match': '"v1"'}])
+
+
+class SpooledListTest(unittest.TestCase):
+    """Keeping the service details of a streaming sync on disk
+    """
+    def test_chunked(self):
+        self.assertEqual(list(chunked(iter(range(5)), 2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+    def test_roundtrip(self):
+        spooled = SpooledList()
+        spooled.append(('b2safe', {'uuid': u'\xe9', 'deps': [1.5, None]}))
+        spooled.append(('b2share', {}))
+        self.assertEqual(len(spooled), 2)
+        for i in range(2):
+            self.assertEqual([tuple(item) for item in spooled],
+                             [('b2safe', {'uuid': u'\xe9',
+                                          'deps': [1.5, None]}),
+                              ('b2share', {})])
+        spooled.close()
+
+    def test_append_while_iterating(self):
+        spooled = SpooledList()
+        spooled.append(1)
+        items = iter(spooled)
+        self.assertEqual(next(items), 1)
+        spooled.append(2)
+        self.assertEqual(list(items), [2])
+        spooled.close()
+
+
+def details(*dependencies):
+    return {'dependencies_list': {'services': [
+        {'service': {'name': name}} for name in dependencies] or None}}
+
+
+class DependenciesTest(unittest.TestCase):
+    """Finding dependency cycles and dangling dependencies
+    """
+    def check(self, *items):
+        names = [id for id, data in items]
+        return checkDependencies(items, lambda dep: dep['service']['name'],
+                                 lambda dep: dep['service']['name'] in names)
+
+    def test_no_cycles(self):
+        self.assertEqual(findCycles({'a': ['b', 'c'], 'b': ['c'], 'c': []}),
+                         [])
+
+    def test_self_loop(self):
+        self.assertEqual(findCycles({'a': ['a']}), [['a', 'a']])
+
+    def test_two_cycle(self):
+        self.assertEqual(findCycles({'a': ['b'], 'b': ['a'], 'c': ['a']}),
+                         [['a', 'b', 'a']])
+
+    def test_report(self):
+        report = self.check(('a', details('b')), ('b', details('a', 'x')),
+                            ('c', details()))
+        self.assertEqual(report, {'dangling': {'b': ['x']},
+                                  'cycles': [['a', 'b', 'a']]})
+
+    def test_dangling(self):
+        report = self.check(('a', details('gone', 'b')), ('b', details()))
+        self.assertEqual(report, {'dangling': {'a': ['gone']},
+                                  'cycles': []})